@@ -25,3 +25,27 @@ DB_PATH = os.path.join(ROOT_DIR, '../../dat/db')
 TREE_PATH = os.path.join(ROOT_DIR, '../../dat/tree')
 INFO_PATH = os.path.join(ROOT_DIR, '../../dat/info')
 INFO_PATH = "./cache.json"
+
+# MediaWiki API used for taxon info lookups. Can be pointed at a mirror or a local stand-in server
+WIKI_API = os.getenv("PHYLO_MATCH_WIKI_API", "https://en.wikipedia.org/w/api.php")
+# Number of lookup requests in flight at once
+LOOKUP_CONCURRENCY = 8
+# Most disk space used by the cache directory, in bytes, and which entries go first past it. Policies are those
+# of diskcache: least-recently-stored, least-recently-used, least-frequently-used or none
+INFO_CACHE_SIZE = int(os.getenv("PHYLO_MATCH_CACHE_SIZE", 1024 ** 3))
+INFO_CACHE_EVICTION = os.getenv("PHYLO_MATCH_CACHE_EVICTION", "least-recently-stored")
+# Taxon info kept in memory in front of the on-disk cache: most entries, and seconds before an entry is re-read
+INFO_MEMORY_CACHE_SIZE = 2048
+INFO_MEMORY_CACHE_TTL = 3600
+# Seconds each kind of lookup result stays cached, None for no limit. Pages found are kept; names with no page
+# or only a disambiguation page are skipped until their entry expires; failed requests are retried soon after
+INFO_FOUND_TTL = None
+INFO_ABSENT_TTL = int(os.getenv("PHYLO_MATCH_ABSENT_TTL", 30 * 24 * 3600))
+INFO_AMBIGUOUS_TTL = int(os.getenv("PHYLO_MATCH_AMBIGUOUS_TTL", 30 * 24 * 3600))
+INFO_TRANSIENT_TTL = int(os.getenv("PHYLO_MATCH_TRANSIENT_TTL", 10 * 60))
+# Widest thumbnail shown next to a suggestion, in pixels
+THUMBNAIL_SIZE = 160
+# Most disk space used by cached thumbnails, in bytes. The least recently used are evicted past it
+IMAGE_CACHE_SIZE = 256 * 1024 * 1024
+# Upcoming records with suggestions whose taxa info is downloaded ahead of time
+PREFETCH_RECORDS = 5
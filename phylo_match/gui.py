@@ -19,17 +19,24 @@
 
 import sys
 import datetime
+import itertools
+import queue
+import threading
+from collections import deque
 
 from argparse import ArgumentParser
 
-from PyQt6.QtGui import QIntValidator, QCloseEvent
+from PyQt6.QtGui import QIntValidator, QCloseEvent, QPixmap
 from PyQt6.uic.properties import QtWidgets
-from diskcache import Cache
 from PyQt6.QtCore import Qt
 from PyQt6.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, \
     QHBoxLayout, QGridLayout, QLabel, QLineEdit
 from phylo_match.definitions.definitions import *
 from phylo_match.match.match import *
+from phylo_match.match.validate import validate
+from phylo_match.match.session import open_session
+from phylo_match.lookup.lookup import WikiLookup, info_entry, STATUS_TTL
+from phylo_match.lookup.cache import CacheWriter, TieredCache, open_cache, migrate_legacy_info, LEGACY_INFO_FILE
 from PyQt6.QtWidgets import *
 from PyQt6.QtCore import *
 
@@ -155,6 +162,15 @@ class MainMenu(QMainWindow):
         self.options_layout.addWidget(self.lbl_integer)
         self.options_layout.addWidget(self.species_index_textbox)
 
+        # Add match worker count selector
+        self.match_workers = multiprocessing.cpu_count()
+        self.lbl_workers = QLabel("Match Workers")
+        self.match_workers_textbox = QLineEdit()
+        self.match_workers_textbox.setPlaceholderText(str(self.match_workers))
+        self.match_workers_textbox.setValidator(QIntValidator(1, 999, self))
+        self.options_layout.addWidget(self.lbl_workers)
+        self.options_layout.addWidget(self.match_workers_textbox)
+
         # Add run button
         self.run_button_spacer = QLabel()
         self.run_button = QPushButton("Run")
@@ -162,6 +178,14 @@ class MainMenu(QMainWindow):
         self.run_button.clicked.connect(self.start_match)
         self.run_button_layout.addWidget(self.run_button_spacer)
         self.run_button_layout.addWidget(self.run_button)
+
+        # Add cancel button, shown while a run is being prepared
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_match)
+        self.cancel_button.hide()
+        self.run_button_layout.addWidget(self.cancel_button)
+        self.run_worker = None
+        self.review_window = None
         self.nexus_file_selected = False
         self.db_file_selected = False
 
@@ -171,7 +195,7 @@ class MainMenu(QMainWindow):
 
     def select_nexus_file(self):
         self.nexus_path = QFileDialog.getOpenFileName(self, 'Open file',
-                                            f'{TREE_PATH}', "Tree files (*.nex)")[0]
+                                            f'{TREE_PATH}', "Tree files (*.nex *.nexus)")[0]
         self.nexus_path_label.setText(os.path.basename(self.nexus_path))
 
         self.nexus_file_selected = True
@@ -197,104 +221,229 @@ class MainMenu(QMainWindow):
         self.run_match()
 
     def run_match(self):
-        compare_window = Compare(self)
-
-        self.prog_label.setText("Analyzing...")
-        self.prog_bar.show()
-        self.prog_bar.setValue(0)
-        QApplication.processEvents()
-
-        self.dialogs.append(compare_window)
-
         self.species_index = self.species_index_textbox.text()
         if self.species_index == '':
             self.species_index = 0
         else:
             self.species_index = int(self.species_index_textbox.text())
 
-        dbs, tree = read_files(self.db_path, self.nexus_path, self.species_index)
-
-        dupes = set()
-        # Check for duplicate entries in dbs
-        for db in dbs:
-            db_dupes = set([x for x in db if db.count(x) > 1])
-            dupes = dupes.union(db_dupes)
-
-        if len(dupes) > 0:
-            msg = QMessageBox()
-            # msg.setIcon(QMessageBox.Critical)
-            msg.setText("Warning: Duplicate Entries")
-            msg.setInformativeText(f"{', '.join(dupes)} appear multiple times")
-            msg.setWindowTitle("Duplicate Entries")
-            msg.exec()
-
-        taxa_list, compare_window.perfect_matches = match(dbs, tree, "_", 4)
-
-        # If option for online lookup, do lookup
-        if self.do_lookup.isChecked():
-            # Cached_info may be cached remotely or locally in future versions
-            # cached_info = read_wiki_file(INFO_PATH, INFO_FNAME)
-            cache = Cache(self.cache_path)
-
-            self.prog_label.setText("Checking Cache...")
-            QApplication.processEvents()
-
-            flat_taxa_list = flatten(taxa_list)
-            missing_info = list(filter(lambda x: x not in cache, flat_taxa_list))
-
-            self.prog_bar.setRange(0, len(missing_info))
-            self.prog_label.setText("Downloading...")
-            QApplication.processEvents()
-
-            p = multiprocessing.Pool(multiprocessing.cpu_count())
-            wiki_entries = p.map_async(get_wiki_section, missing_info)
-            p.close()
-
-            # Loading Bar
-            while (True):
-                if (wiki_entries.ready()): break
-                self.prog_bar.setValue(len(missing_info) - wiki_entries._number_left * wiki_entries._chunksize)
-
-                # Simple animation
-                text = self.prog_label.text
-                if text == "Downloading...":
-                    self.prog_label.setText("Downloading.")
-                elif text == "Downloading.":
-                    self.prog_label.setText("Downloading..")
-                else:
-                    self.prog_label.setText("Downloading...")
-
-                QApplication.processEvents()
-                time.sleep(0.5)
-
-
-            self.prog_label.setText("Caching...")
-            QApplication.processEvents()
+        if self.match_workers_textbox.text() == '':
+            self.match_workers = multiprocessing.cpu_count()
+        else:
+            self.match_workers = int(self.match_workers_textbox.text())
 
-            # Cache items
-            for key in missing_info:
-                value = get_wiki_section(key)
-                cache.set(key, value)
+        self.run_button.setEnabled(False)
+        self.cancel_button.show()
+        self.prog_label.setText("Analyzing...")
+        self.prog_bar.show()
+        # Busy indicator until matching reports its progress
+        self.prog_bar.setRange(0, 0)
+
+        # Everything up to review runs on a background thread, so this window stays responsive
+        self.run_worker = RunWorker(self.db_path, self.species_index, self.nexus_path, self.cache_path,
+                                    self.match_workers, self)
+        # The review window is made with the run, so it receives every record that needs review.
+        # It opens when the first one arrives
+        self.review_window = Compare(self)
+        self.review_window.set_run_worker(self.run_worker)
+        self.run_worker.stage.connect(self.prog_label.setText)
+        self.run_worker.progress.connect(self.show_progress)
+        self.run_worker.validated.connect(self.show_validation)
+        self.run_worker.failed.connect(self.run_failed)
+        self.run_worker.ready.connect(self.start_review)
+        self.run_worker.finished.connect(self.run_finished)
+        self.run_worker.start()
+
+    def cancel_match(self):
+        if self.run_worker is not None:
+            self.run_worker.requestInterruption()
+            self.prog_label.setText("Cancelling...")
+
+    def show_progress(self, done, total):
+        self.prog_bar.setRange(0, total)
+        self.prog_bar.setValue(done)
+
+    # Shows the problems validate() found. The first few entries of each are listed, the rest under 'Show Details'
+    def show_validation(self, report):
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Icon.Warning)
+        msg.setText("Warning: Check Database and Tree")
+        msg.setInformativeText(report.summary())
+        msg.setDetailedText(report.details())
+        msg.setWindowTitle("Validation")
+        msg.exec()
+
+    def run_failed(self, title, message):
+        # Close a review that was already showing results from this run, without asking or saving
+        for dialog in self.dialogs:
+            if dialog.run_worker is self.run_worker and dialog.isVisible():
+                dialog.force_quit = True
+                dialog.stop_loaders()
+                dialog.close()
+        self.show()
+        QMessageBox.critical(self, title, message)
+
+    def run_finished(self):
+        # The run ended before there was anything to review
+        if self.review_window not in self.dialogs:
+            self.review_window.deleteLater()
+        self.run_button.setEnabled(True)
+        self.cancel_button.hide()
+        if self.run_worker.isInterruptionRequested() or not self.run_worker.completed:
+            self.prog_label.setText("")
+        self.prog_bar.hide()
+        self.prog_bar.setRange(0, 1)
+        self.prog_bar.setValue(0)
 
-        self.prog_label.setText("Done!")
-        QApplication.processEvents()
+    # Opens the review window once the first match result is ready. The rest keep arriving while reviewing
+    def start_review(self):
+        worker = self.run_worker
+        compare_window = self.review_window
+        self.dialogs.append(compare_window)
 
-        compare_window.__init__(self)
         compare_window.setParent(self)
         compare_window.move(self.pos())
         compare_window.species_index = self.species_index
         compare_window.set_db_path(self.db_path)
         compare_window.set_do_lookup(self.do_lookup.isChecked())
+        compare_window.set_session(worker.session)
+        # Perfect matches are split out by the worker and never reach the review window
+        compare_window.set_perfect_matches(worker.perfect_matches)
+        compare_window.perfect_match_count = len(worker.perfect_matches)
 
+        # Taxa info goes through a bounded in-memory tier in front of the same directory as the match results
+        cache = TieredCache(worker.store)
         compare_window.set_cache(cache)
-        compare_window.compare_mismatch(iter(taxa_list))
+        if self.do_lookup.isChecked():
+            # Taxa info is downloaded in the background as records come up, instead of all before the first one
+            compare_window.set_info_loader(InfoLoader(cache))
+            # Thumbnails have their own size-capped cache, so they can never push taxa info out
+            images = open_cache(os.path.join(self.cache_path, "images"), IMAGE_CACHE_SIZE, "least-recently-used")
+            compare_window.set_image_loader(ImageLoader(images))
+        compare_window.compare_mismatch()
 
         self.hide()
-        self.prog_bar.hide()
-        self.prog_bar.setValue(0)
         self.prog_label.setText("")
 
 
+# Reads the database and tree, validates their names and matches on a background thread. Stages and progress
+# are reported through signals. Records that need review are sent through the record signal as they are made, so
+# review can start with the first one; perfect matches are only counted. requestInterruption() cancels the run
+# between steps. A completed run's output is kept in the session for the two files, and handed over from there
+# without reading or matching when they are run again.
+class RunWorker(QThread):
+    stage = pyqtSignal(str)
+    progress = pyqtSignal(int, int)
+    validated = pyqtSignal(object)
+    record = pyqtSignal(object)
+    failed = pyqtSignal(str, str)
+    ready = pyqtSignal()
+
+    def __init__(self, db_path, species_index, nexus_path, cache_path, match_workers, parent=None):
+        super(RunWorker, self).__init__(parent)
+        self.db_path = db_path
+        self.species_index = species_index
+        self.nexus_path = nexus_path
+        self.cache_path = cache_path
+        self.match_workers = match_workers
+        self.store = None
+        self.session = None
+        self.perfect_matches = []
+        # Only set once every entry has been matched
+        self.completed = False
+
+    def run(self):
+        try:
+            self.match()
+        except Exception as e:
+            self.failed.emit("Run Failed", str(e))
+
+    def match(self):
+        self.stage.emit("Checking for a saved session...")
+        self.session = open_session(self.cache_path, self.db_path, self.nexus_path, self.species_index, "_", 4)
+        snapshot = self.session.load_snapshot()
+        if snapshot is not None:
+            self.resume(*snapshot)
+            return
+        if self.isInterruptionRequested():
+            return
+
+        self.stage.emit("Reading database...")
+        try:
+            dbs = read_dbs(self.db_path, self.species_index)
+        except ValueError as e:
+            self.failed.emit("Malformed Database", str(e))
+            return
+        if self.isInterruptionRequested():
+            return
+
+        self.stage.emit("Loading tree...")
+        # Compiled tree index is kept next to the cache and reused until the tree file changes
+        tree = load_tree_index(self.nexus_path, self.cache_path, "_", 4)
+        if self.isInterruptionRequested():
+            return
+
+        self.stage.emit("Validating...")
+        # Duplicates, malformed names and spelling variants, each reported once
+        report = validate(dbs, tree.names, "_")
+        if report:
+            self.validated.emit(report)
+        if self.isInterruptionRequested():
+            return
+
+        # Match results are cached alongside taxa info, so re-runs only match new or changed names
+        self.store = open_cache(self.cache_path)
+        migrate_legacy_info(self.store, os.path.join(self.cache_path, LEGACY_INFO_FILE))
+        self.perfect_matches = find_perfect_matches(dbs, tree)
+
+        self.stage.emit("Matching...")
+        total = sum(len(db) for db in dbs)
+        # About a hundred progress updates however many entries there are
+        step = max(1, total // 100)
+        taxa_iter = iter_match(dbs, tree, "_", 4, workers=self.match_workers, cache=self.store)
+        pending = 0
+        # A name that appears on several rows is reviewed once; its choice is applied to every row
+        reviewed = set()
+        with self.session.write_snapshot(self.perfect_matches, report) as snapshot:
+            try:
+                for done, result in enumerate(taxa_iter, 1):
+                    if self.isInterruptionRequested():
+                        return
+                    # Type Str is a perfect match, already counted in perfect_matches
+                    if type(result) != str and result[0] not in reviewed:
+                        reviewed.add(result[0])
+                        snapshot.add(result)
+                        self.record.emit(result)
+                        pending += 1
+                        if pending == 1:
+                            self.ready.emit()
+                    if done % step == 0 or done == total:
+                        self.progress.emit(done, total)
+            finally:
+                # Stops the match workers and stores what was matched so far
+                taxa_iter.close()
+            snapshot.commit()
+
+        self.completed = True
+        self.stage.emit("Done!")
+        # Nothing to review; the review window still opens to save the output
+        if pending == 0:
+            self.ready.emit()
+
+    # Hands over the output of an earlier run of the same files, with its validation warnings
+    def resume(self, perfect_matches, records, report):
+        if report:
+            self.validated.emit(report)
+        self.store = open_cache(self.cache_path)
+        migrate_legacy_info(self.store, os.path.join(self.cache_path, LEGACY_INFO_FILE))
+        self.perfect_matches = perfect_matches
+        for record in records:
+            self.record.emit(record)
+        self.completed = True
+        self.stage.emit("Done!")
+        self.ready.emit()
+
+
 # dialog.close()
 
 #
@@ -305,6 +454,212 @@ class MainMenu(QMainWindow):
 # compare.compare_mismatch(self, iter(taxa_list))
 
 
+# Downloads taxa info on a background thread and reports each result through the loaded signal, which Qt
+# delivers on the GUI thread. Titles shown on screen are fetched before prefetched ones. Results are written
+# through to the cache. A title asked for again before its result is written is answered from the writer's
+# pending batch.
+class InfoLoader(QObject):
+    loaded = pyqtSignal(str, str)
+
+    # Queue priorities
+    VISIBLE = 0
+    PREFETCH = 1
+
+    def __init__(self, cache, endpoint=WIKI_API, concurrency=LOOKUP_CONCURRENCY):
+        super(InfoLoader, self).__init__()
+        self.cache = cache
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.requested = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queues titles for download. A title is prefetched once; visible titles are always queued, so every label
+    # waiting on one gets an answer, even for a title that was prefetched or has already arrived
+    def request(self, titles, priority=PREFETCH):
+        for title in titles:
+            with self.lock:
+                if priority != self.VISIBLE and title in self.requested:
+                    continue
+                self.requested.add(title)
+            self.queue.put((priority, next(self.order), title))
+
+    def stop(self):
+        self.queue.put((-1, next(self.order), None))
+
+    def run(self):
+        with WikiLookup(self.endpoint, self.concurrency) as lookup, CacheWriter(self.cache) as writer:
+
+            def on_result(title, status, summary):
+                writer.set(title, (status, summary), expire=STATUS_TTL[status])
+                self.loaded.emit(title, summary)
+
+            while True:
+                # Take the most urgent title, then fill a batch with whatever else is waiting
+                batch = [self.queue.get()[2]]
+                while len(batch) < lookup.batch_size * lookup.concurrency and not self.queue.empty():
+                    batch.append(self.queue.get()[2])
+                if None in batch:
+                    return
+                missing = []
+                for title in dict.fromkeys(batch):
+                    # Anything that arrived since it was queued doesn't need downloading
+                    entry = info_entry(writer.get(title))
+                    if entry is None:
+                        entry = info_entry(self.cache.get(title))
+                    if entry is not None:
+                        self.loaded.emit(title, entry[1])
+                    else:
+                        missing.append(title)
+                self.download(lookup, missing, on_result)
+                writer.flush()
+
+    # Downloads a batch of titles, calling on_result(title, status, result) as each one arrives
+    def download(self, lookup, batch, on_result):
+        lookup.fetch(batch, on_result)
+
+
+# Downloads suggestion thumbnails the same way, into a separate image cache
+class ImageLoader(InfoLoader):
+    loaded = pyqtSignal(str, bytes)
+
+    def download(self, lookup, batch, on_result):
+        lookup.fetch_thumbnails(batch, THUMBNAIL_SIZE, on_result)
+
+
+# Width of one suggestion in the suggestion list, in pixels
+SUGGESTION_WIDTH = 220
+
+
+# One suggestion: thumbnail, selection button and taxa info. Cards are reused for whichever suggestions are
+# in view, so their widgets are built once
+class SuggestionCard(QWidget):
+    def __init__(self, compare_window, parent=None):
+        super(SuggestionCard, self).__init__(parent)
+        self.compare_window = compare_window
+        self.taxa = None
+        self.on_choose = None
+        self.setFixedWidth(SUGGESTION_WIDTH)
+
+        layout = QVBoxLayout(self)
+        layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.setContentsMargins(10, 5, 10, 5)
+
+        # Thumbnail, filled in when it has downloaded
+        self.image_label = QLabel()
+        self.image_label.setFixedHeight(THUMBNAIL_SIZE)
+        self.image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(self.image_label)
+
+        # Create taxa selection button
+        self.button = QPushButton(self)
+        self.button.setStyleSheet("padding: 20px; border-radius: 15px; background-color: gray;")
+        self.button.clicked.connect(lambda: self.on_choose(self.taxa))
+        layout.addWidget(self.button)
+
+        # Create text box from wiki, in a scroll area
+        self.info_label = QLabel()
+        self.info_label.setScaledContents(True)
+        self.info_label.setWordWrap(True)
+        self.info_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.info_scroll = QScrollArea()
+        self.info_scroll.setWidget(self.info_label)
+        self.info_scroll.setWidgetResizable(True)
+        self.info_scroll.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.info_scroll.setFixedHeight(200)
+        self.info_scroll.setMaximumWidth(200)
+        layout.addWidget(self.info_scroll)
+
+    def set_taxa(self, taxa, on_choose):
+        self.taxa = taxa
+        self.on_choose = on_choose
+        self.button.setText(taxa)
+
+        compare_window = self.compare_window
+        self.image_label.setVisible(compare_window.image_loader is not None)
+        if compare_window.image_loader is not None:
+            compare_window.show_thumbnail(self.image_label, taxa)
+        self.info_scroll.setVisible(compare_window.do_lookup)
+        if compare_window.do_lookup:
+            compare_window.show_info(self.info_label, taxa)
+
+
+# Horizontal list of suggestions with cards only for the suggestions in view. Scrolling rebinds the same cards
+# to other suggestions, so a category of hundreds costs no more to show than one that just fills the view
+class SuggestionList(QWidget):
+    def __init__(self, compare_window, parent=None):
+        super(SuggestionList, self).__init__(parent)
+        self.compare_window = compare_window
+        self.items = []
+        self.on_choose = None
+        self.cards = []
+        # Wheel rotation not yet turned into a step, for touchpads that scroll a little at a time
+        self.wheel_delta = 0
+        self.setMaximumWidth(800)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.cards_layout = QHBoxLayout()
+        self.cards_layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.addLayout(self.cards_layout)
+        self.scroll_bar = QScrollBar(Qt.Orientation.Horizontal)
+        self.scroll_bar.valueChanged.connect(self.bind)
+        layout.addWidget(self.scroll_bar)
+
+    # Number of cards that fit in the current width
+    def visible_count(self):
+        return max(1, self.width() // SUGGESTION_WIDTH)
+
+    # Shows items from the start. on_choose(item) is called when one is clicked
+    def set_items(self, items, on_choose):
+        self.items = list(items)
+        self.on_choose = on_choose
+        self.update_range()
+        # Rebinds even if the value was already 0
+        self.scroll_bar.blockSignals(True)
+        self.scroll_bar.setValue(0)
+        self.scroll_bar.blockSignals(False)
+        self.bind()
+
+    def update_range(self):
+        visible = self.visible_count()
+        self.scroll_bar.setRange(0, max(0, len(self.items) - visible))
+        self.scroll_bar.setPageStep(visible)
+        self.scroll_bar.setVisible(len(self.items) > visible)
+
+    # Binds the cards to the items in view, adding cards only when more fit than have been built
+    def bind(self):
+        first = self.scroll_bar.value()
+        in_view = self.items[first:first + self.visible_count()]
+        while len(self.cards) < len(in_view):
+            card = SuggestionCard(self.compare_window, self)
+            self.cards.append(card)
+            self.cards_layout.addWidget(card)
+        for i, card in enumerate(self.cards):
+            if i < len(in_view):
+                card.set_taxa(in_view[i], self.on_choose)
+                card.show()
+            else:
+                card.hide()
+
+    def resizeEvent(self, event):
+        super(SuggestionList, self).resizeEvent(event)
+        self.update_range()
+        self.bind()
+
+    # One card per wheel notch (120 units). Smaller deltas add up until they make a whole notch either way
+    def wheelEvent(self, event):
+        delta = event.angleDelta()
+        self.wheel_delta += delta.y() or delta.x()
+        steps = int(self.wheel_delta / 120)
+        self.wheel_delta -= steps * 120
+        if steps:
+            self.scroll_bar.setValue(self.scroll_bar.value() - steps)
+
+
 class Compare(QMainWindow):
     def __init__(self, parent=None):
         super(Compare, self).__init__(parent)
@@ -313,6 +668,18 @@ class Compare(QMainWindow):
         self.db_path = ""
         self.do_lookup = False
         self.cache = None
+        self.run_worker = None
+        # Set while the run is still sending records, and while review is waiting for the next one
+        self.matching = False
+        self.waiting = False
+        self.session = None
+        # Decisions from an earlier sitting still to be applied to their records, in review order
+        self.replay = deque()
+        self.info_loader = None
+        # Labels waiting for downloads -> the taxa they are waiting for
+        self.info_labels = {}
+        self.image_loader = None
+        self.image_labels = {}
 
         # Create main_layout
         self.main_widget = QWidget()
@@ -335,10 +702,11 @@ class Compare(QMainWindow):
         self.count_layout = QHBoxLayout()
         self.main_layout.addLayout(self.count_layout, 0, 1)
 
-        self.suggestions_sub_layout = QHBoxLayout()
-        self.suggestions_scroll_area = QScrollArea()
+        # Built once; each record and category only rebinds its cards
+        self.suggestion_list = SuggestionList(self)
 
         self.suggestions_scrolling_layout = QHBoxLayout()
+        self.suggestions_scrolling_layout.addWidget(self.suggestion_list)
         self.main_layout.addLayout(self.suggestions_scrolling_layout, 1, 1)
 
         self.manual_entry_layout = QVBoxLayout()
@@ -388,21 +756,43 @@ class Compare(QMainWindow):
 
         # Init global variables
         self.removed_suggestions = []
-        self.taxa_list = []
+        # Tree names already used, by perfect matches or decisions so far
+        self.chosen = set()
+        # DB name -> chosen tree name, for every record that gets a new name
+        self.replacements = {}
+        self.db_taxa = ""
         self.species_index = 0
+        self.perfect_matches = []
+        self.perfect_match_count = 0
         self.force_quit = False
+        # Records that need review, in DB order, as they have been pulled from the match output,
+        # and the index of the one on screen
+        self.pending = []
+        self.position = -1
 
     def closeEvent(self, event, *args, **kwargs):
 
         if self.force_quit:
+            if self.session is not None:
+                self.session.close()
             event.accept()
         else:
-            ## TODO: Add pop up box with option to save progress
+            if self.session is not None:
+                message = "Are you sure want to quit? Your choices so far are saved and will be restored " \
+                          "the next time these files are run"
+            else:
+                message = "Are you sure want to quit? Progress will not be saved"
             close = QMessageBox.question(self,
                                          "QUIT",
-                                         "Are you sure want to quit? Progress will not be saved",
+                                         message,
                                          QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
             if close == QMessageBox.StandardButton.Yes:
+                self.waiting = False
+                self.stop_loaders()
+                if self.session is not None:
+                    self.session.close()
+                if self.run_worker is not None:
+                    self.run_worker.requestInterruption()
                 # Open main menu
                 self.parent().show()
                 self.parent().move(self.pos())
@@ -416,47 +806,214 @@ class Compare(QMainWindow):
     def set_do_lookup(self, do_lookup):
         self.do_lookup = do_lookup
 
+    def set_perfect_matches(self, perfect_matches):
+        self.perfect_matches = perfect_matches
+        self.chosen.update(perfect_matches)
+
+    # Decisions are saved to the session as they are made, and those saved earlier are applied first
+    def set_session(self, session):
+        self.session = session
+        self.replay = deque(session.decisions())
+        if self.replay:
+            self.statusBar().showMessage(f"Restored {len(self.replay)} earlier choices")
+
     def set_cache(self, cache):
         self.cache = cache
 
-    def compare_mismatch(self, taxa_iter):
-
-        next_taxa = next(taxa_iter, None)
+    def set_info_loader(self, info_loader):
+        self.info_loader = info_loader
+        self.info_loader.loaded.connect(self.fill_info)
+
+    def set_run_worker(self, run_worker):
+        self.run_worker = run_worker
+        self.matching = True
+        self.run_worker.progress.connect(self.show_match_progress)
+        self.run_worker.record.connect(self.add_record)
+        self.run_worker.finished.connect(self.end_matching)
+
+    # Takes a record that needs review from the run. If review was waiting for it, it is shown; if it is one of
+    # the next few, its taxa info is prefetched
+    def add_record(self, record):
+        self.pending.append(record)
+        if self.waiting:
+            self.compare_mismatch()
+        elif self.position >= 0 and len(self.pending) - 1 - self.position <= PREFETCH_RECORDS:
+            self.prefetch_records([record])
+
+    # Every record has arrived, or the run failed or was cancelled
+    def end_matching(self):
+        self.matching = False
+        if self.waiting:
+            self.compare_mismatch()
+
+    # Matching carries on while the first records are reviewed
+    def show_match_progress(self, done, total):
+        if done < total:
+            self.statusBar().showMessage(f"Matched {done} of {total} entries")
+        else:
+            self.statusBar().clearMessage()
+
+    def set_image_loader(self, image_loader):
+        self.image_loader = image_loader
+        self.image_loader.loaded.connect(self.fill_image)
+
+    def stop_loaders(self):
+        # Review is over; keep this sitting's hit and miss counts for the cache stats
+        if self.cache is not None:
+            self.cache.save_stats()
+        if self.info_loader is not None:
+            self.info_loader.stop()
+            self.info_loader = None
+        if self.image_loader is not None:
+            self.image_loader.stop()
+            self.image_loader = None
+
+    # Replaces the placeholder of every label waiting on this taxon
+    def fill_info(self, taxa, summary):
+        for label in [label for label, waiting in self.info_labels.items() if waiting == taxa]:
+            del self.info_labels[label]
+            try:
+                label.setText(summary)
+            except RuntimeError:
+                # Label was deleted when the record changed
+                pass
+
+    def fill_image(self, taxa, image):
+        for label in [label for label, waiting in self.image_labels.items() if waiting == taxa]:
+            del self.image_labels[label]
+            try:
+                self.set_thumbnail(label, image)
+            except RuntimeError:
+                # Label was deleted when the record changed
+                pass
+
+    # Shows the info for taxa in label, or a placeholder until the download arrives
+    def show_info(self, label, taxa):
+        self.info_labels.pop(label, None)
+        entry = info_entry(self.cache.get(taxa)) if self.cache is not None else None
+        if entry is not None:
+            label.setText(entry[1])
+        elif self.info_loader is not None:
+            label.setText("Loading...")
+            self.info_labels[label] = taxa
+            self.info_loader.request([taxa], InfoLoader.VISIBLE)
+        else:
+            try:
+                label.setText(get_wiki_section(taxa, cache=self.cache))
+            except:
+                label.setText("No information found")
+
+    # Shows the thumbnail for taxa in label, once it has downloaded
+    def show_thumbnail(self, label, taxa):
+        self.image_labels.pop(label, None)
+        label.clear()
+        entry = info_entry(self.image_loader.cache.get(taxa))
+        if entry is not None:
+            self.set_thumbnail(label, entry[1])
+        else:
+            self.image_labels[label] = taxa
+            self.image_loader.request([taxa], InfoLoader.VISIBLE)
+
+    @staticmethod
+    def set_thumbnail(label, image):
+        if not image:
+            return
+        pixmap = QPixmap()
+        if pixmap.loadFromData(image):
+            if pixmap.width() > THUMBNAIL_SIZE:
+                pixmap = pixmap.scaledToWidth(THUMBNAIL_SIZE, Qt.TransformationMode.SmoothTransformation)
+            label.setPixmap(pixmap)
+
+    # Queues info downloads for the next few records that have arrived, so they are ready when reached.
+    # Only records already here are used, so this never waits on matching; later ones are prefetched by
+    # add_record as they arrive
+    def prefetch_info(self):
+        self.prefetch_records(self.pending[self.position + 1:self.position + 1 + PREFETCH_RECORDS])
+
+    def prefetch_records(self, records):
+        if self.info_loader is None:
+            return
+        upcoming_taxa = flatten(records)
+        self.info_loader.request(upcoming_taxa, InfoLoader.PREFETCH)
+        if self.image_loader is not None:
+            self.image_loader.request(upcoming_taxa, InfoLoader.PREFETCH)
+
+    # Moves to the next record that needs review and returns it, or None if it hasn't arrived yet or there are
+    # none left. Records decided in an earlier sitting are skipped in a loop, so however many come in a row
+    # the stack stays flat
+    def next_pending(self):
+        while self.position + 1 < len(self.pending):
+            self.position += 1
+            next_taxa = self.pending[self.position]
+            if not self.replay or self.replay[0][0] != next_taxa[0]:
+                # Saved decisions only hold while they line up with the records
+                self.replay.clear()
+                return next_taxa
+            self.db_taxa, choice = self.replay.popleft()
+            self.decide(choice, save=False)
+        return None
+
+    # Records the choice for the record on screen, "" to leave it as is
+    def decide(self, suggestion, save=True):
+        if suggestion != "":
+            self.chosen.add(suggestion)
+            self.replacements[self.db_taxa] = suggestion
+        if save and self.session is not None:
+            self.session.record(self.db_taxa, suggestion)
+
+    # Shows the next record that needs review, waits for it if matching hasn't got there yet, or saves the
+    # results once there are none left. Each decision calls this again from its button handler, and each
+    # record that arrives while waiting calls it from add_record, so it never recurses
+    def compare_mismatch(self):
+
+        next_taxa = self.next_pending()
         if next_taxa:
-            # Type Str indicates to move on
-            if type(next_taxa) == str:
-                self.taxa_list.append(next_taxa)
-                self.compare_mismatch(taxa_iter)
-            else:
-                db_taxa = next_taxa[0]
+            self.waiting = False
+            self.set_controls_enabled(True)
+            db_taxa = next_taxa[0]
+            self.db_taxa = db_taxa
 
-                next_taxa = self.remove_chosen_entries(next_taxa)
+            next_taxa = self.remove_chosen_entries(next_taxa)
 
-                loose_suggestions = next_taxa[4]  # bool indicating whether suggestion has loosened params
+            loose_suggestions = next_taxa[4]  # bool indicating whether suggestion has loosened params
 
-                # If suggestions are loose, default to showing them last
-                if loose_suggestions:
-                    if len(next_taxa[2]) > 0:
-                        i = 2
-                    elif len(next_taxa[3]) > 0:
-                        i = 3
-                    else:
-                        i = 1
+            # If suggestions are loose, default to showing them last
+            if loose_suggestions:
+                if len(next_taxa[2]) > 0:
+                    i = 2
+                elif len(next_taxa[3]) > 0:
+                    i = 3
                 else:
                     i = 1
+            else:
+                i = 1
 
-                self.show_suggestions(next_taxa, taxa_iter, i)
+            self.show_suggestions(next_taxa, i)
 
-                self.taxa_label.setText(db_taxa)
-                self.show()
+            self.taxa_label.setText(db_taxa)
+            self.show()
+
+            self.prefetch_info()
+        elif self.matching:
+            self.show_waiting()
         else:
+            self.waiting = False
+            self.stop_loaders()
+
+            # Results ran out because the run failed or was cancelled; its handler closes this window
+            if self.run_worker is not None and not self.run_worker.completed:
+                return
+
             # End of file, record results
-            filepath = write_file(self.taxa_list, self.db_path, self.species_index)
+            filepath = write_file(self.replacements, self.db_path, self.species_index)
+            if self.session is not None:
+                self.session.finish()
 
             # Success message
             QMessageBox.information(self,
                                      "Complete!",
-                                     f"Selections saved as {filepath}",)
+                                     f"Selections saved as {filepath}\n"
+                                     f"{self.perfect_match_count} entries matched the tree exactly",)
 
             # Open main menu
             self.parent().show()
@@ -466,49 +1023,70 @@ class Compare(QMainWindow):
             self.force_quit = True
             self.close()
 
-    def make_confirm_function(self, suggestion, taxa_iter, compare_window):
+    # Shown when review has caught up with matching. Choices are switched off until the next record arrives
+    def show_waiting(self):
+        self.waiting = True
+        self.info_labels.clear()
+        self.image_labels.clear()
+        self.taxa_info.setParent(None)
+        self.removed_suggestions_scroll_area.setParent(None)
+        self.removed_suggestions_count.setText("")
+        self.suggestion_list.set_items([], None)
+        self.set_controls_enabled(False)
+        self.taxa_label.setText("Waiting for matches...")
+        self.show()
+
+    def set_controls_enabled(self, enabled):
+        for widget in (self.similar_entries_count, self.same_species_count, self.same_genus_count,
+                       self.line_edit, self.leave_btn):
+            widget.setEnabled(enabled)
+        if not enabled:
+            self.manual_btn.setEnabled(False)
+
+    def make_confirm_function(self, suggestion, compare_window):
         def confirm_suggestion():
-            self.taxa_list.append(suggestion)
+            self.decide(suggestion)
 
             self.line_edit.clear()
             self.removed_suggestions.clear()
 
-            self.compare_mismatch(taxa_iter)
+            self.compare_mismatch()
 
         return confirm_suggestion
 
+    # Returns the record with suggestions that have already been chosen removed from every category, in one pass
+    # over the suggestions. The record itself is left as it was. removed_suggestions gets each removed name once,
+    # even if it was in several categories
     def remove_chosen_entries(self, taxa):
 
-        taxa_name = taxa[0]
-
-        for i, taxa_suggestions in enumerate(taxa[0:-1]):
-            if type(taxa_suggestions) != str:
-                for suggestion in taxa_suggestions:
-                    # Remove suggestions that have already been chosen
-                    # TODO: do this for entire suggestions list at beginning of new taxa to avoid changing once clicking
-                    if suggestion in self.taxa_list or suggestion in self.perfect_matches:
-                        self.removed_suggestions.append(suggestion)
-                        continue
-                taxa[i] = [x for x in taxa_suggestions if x not in self.removed_suggestions]
+        removed = {}
+        taxa = list(taxa)
+        for i in range(1, 4):
+            kept = []
+            for suggestion in taxa[i]:
+                if suggestion in self.chosen:
+                    removed[suggestion] = None
+                else:
+                    kept.append(suggestion)
+            taxa[i] = kept
+        self.removed_suggestions = list(removed)
         return taxa
 
-    def confirm_text(self, suggestion, taxa_iter, compare_window):
+    def confirm_text(self, suggestion, compare_window):
         # TODO: close window more intelligently
-        self.taxa_list.append(suggestion)
+        # Blank means leave as is
+        self.decide(suggestion)
 
         self.line_edit.clear()
         self.removed_suggestions.clear()
 
-        self.compare_mismatch(taxa_iter)
+        self.compare_mismatch()
 
     def create_wiki_scroll_area(self, taxa):
         # Create text box from wiki
         label = QLabel()
         label.setScaledContents(True)
-        try:
-            label.setText(get_wiki_section(taxa, cache=self.cache))
-        except:
-            label.setText("No information found")
+        self.show_info(label, taxa)
         label.setWordWrap(True)
         label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         label.show()
@@ -523,40 +1101,6 @@ class Compare(QMainWindow):
 
         return scroll
 
-    def create_taxa_layout(self, taxa, taxa_iter):
-        # TODO: reimplement count_layout?
-
-        # url_image = get_wiki_image(taxa)
-        # Get wiki information, and image if it's available
-        # try:
-        #     if url_image != 0:
-        #         image = QImage()
-        #         image.loadFromData(requests.get(url_image).content)
-        #
-        #         label.setPixmap(QPixmap(image))
-        # except:
-        #     label.setText("Cannot find " + taxa)
-
-        # Create base main_layout for taxa selection
-        taxa_layout = QVBoxLayout()
-        taxa_layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
-
-        # Create taxa selection button
-        btn = QPushButton(taxa, self)
-        btn.setStyleSheet("padding: 20px; border-radius: 15px; background-color: gray;")
-        # btn.adjustSize()
-        f = self.make_confirm_function(taxa, taxa_iter, self)
-        btn.clicked.connect(f)
-        taxa_layout.addWidget(btn)
-
-        if self.do_lookup:
-            scroll = self.create_wiki_scroll_area(taxa)
-            taxa_layout.addWidget(scroll)
-
-        taxa_layout.setContentsMargins(10, 5, 10, 5)
-
-        return taxa_layout
-
     def create_removed_suggestions_scroll_area(self, removed_suggestions_text):
         # Create text box from wiki
         label = QLabel()
@@ -579,29 +1123,12 @@ class Compare(QMainWindow):
 
         return scroll
 
-    def create_suggestions_scroll_area(self):
-        scroll = QScrollArea()
-        widget = QWidget()
-        widget.setContentsMargins(0, 0, 0, 0)
-        widget.setLayout(self.suggestions_sub_layout)
-        scroll.setWidget(widget)
-        scroll.setWidgetResizable(True)
-        scroll.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        scroll.setFixedHeight(400)
-        scroll.setMaximumWidth(800)
+    def show_suggestions(self, next_taxa, match_type):
 
-        return scroll
-
-    def show_suggestions(self, next_taxa, taxa_iter, match_type):
-
-        # Clear old buttons + count_layout
-        for j in reversed(range(self.suggestions_sub_layout.count())):
-            layout = self.suggestions_sub_layout.itemAt(j).layout()
-            self.suggestions_sub_layout.removeItem(layout)
-            for k in reversed(range(layout.count())):
-                layout.itemAt(k).widget().setParent(None)
+        # Labels of the previous screen no longer need filling
+        self.info_labels.clear()
+        self.image_labels.clear()
 
-        self.suggestions_scroll_area.setParent(None)
         self.taxa_info.setParent(None)
 
 
@@ -629,14 +1156,9 @@ class Compare(QMainWindow):
             h_layout.addWidget(self.taxa_info)
             self.taxa_layout.insertLayout(0, h_layout)
 
-        for suggestion in category_suggestions:
-
-            # Add info and image widget to page
-            suggestion_layout = self.create_taxa_layout(suggestion, taxa_iter)
-            self.suggestions_sub_layout.addLayout(suggestion_layout)
-
-        self.suggestions_scroll_area = self.create_suggestions_scroll_area()
-        self.suggestions_scrolling_layout.addWidget(self.suggestions_scroll_area)
+        # Only the suggestions in view get cards, however long the category is
+        self.suggestion_list.set_items(category_suggestions,
+                                       lambda suggestion: self.make_confirm_function(suggestion, self)())
 
 
         # TODO: get this logic outside of the category_suggestions, so it's not doing it every time
@@ -666,11 +1188,11 @@ class Compare(QMainWindow):
         # Link buttons, if category_suggestions exist for those categories
         ## TODO: Refactor to use strings instead of ints for clearer indications of what these numbers mean
         if num_suggestions[0] > 0: self.similar_entries_count.clicked.connect(
-            lambda: self.show_suggestions(next_taxa, taxa_iter, 1))
+            lambda: self.show_suggestions(next_taxa, 1))
         if num_suggestions[1] > 0: self.same_species_count.clicked.connect(
-            lambda: self.show_suggestions(next_taxa, taxa_iter, 2))
+            lambda: self.show_suggestions(next_taxa, 2))
         if num_suggestions[2] > 0: self.same_genus_count.clicked.connect(
-            lambda: self.show_suggestions(next_taxa, taxa_iter, 3))
+            lambda: self.show_suggestions(next_taxa, 3))
 
         if match_type == 1:
             self.setWindowTitle("Similar Entries")
@@ -694,9 +1216,9 @@ class Compare(QMainWindow):
         # Chooses the text entry box
         self.manual_btn.setEnabled(False)
         self.line_edit.textChanged.connect(self.disableManualButton)
-        self.manual_btn.clicked.connect(lambda: self.confirm_text(self.line_edit.text(), taxa_iter, self))
+        self.manual_btn.clicked.connect(lambda: self.confirm_text(self.line_edit.text(), self))
         # Chooses the text entry box
-        self.leave_btn.clicked.connect(lambda: self.confirm_text("", taxa_iter, self))
+        self.leave_btn.clicked.connect(lambda: self.confirm_text("", self))
 
     def disableManualButton(self):
         if len(self.line_edit.text()) > 0:
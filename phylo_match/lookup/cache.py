@@ -0,0 +1,288 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from pathlib import Path
+
+from diskcache import Cache
+
+from phylo_match.definitions.definitions import INFO_MEMORY_CACHE_SIZE, INFO_MEMORY_CACHE_TTL, INFO_CACHE_SIZE, \
+    INFO_CACHE_EVICTION
+from phylo_match.lookup.lookup import info_entry, STATUS_TTL
+
+# Marks a missing entry, since None can be a stored value
+_MISSING = object()
+
+# Older versions kept taxa info in one JSON file; it is moved into the cache the first time the cache is opened
+LEGACY_INFO_FILE = "info.json"
+# First part of the cache keys recording which legacy files have been moved in
+_MIGRATED_KEY = "legacy-info-migrated"
+# Hit and miss counts saved by TieredCache.save_stats(), for cache_stats()
+_HITS_KEY = ("cache-stats", "hits")
+_MISSES_KEY = ("cache-stats", "misses")
+
+# Results held before they are committed together
+WRITE_BATCH_SIZE = 100
+# Longest a result waits before it is committed, in seconds
+WRITE_BATCH_SECONDS = 2.0
+
+
+# Writes lookup results to a diskcache Cache as they arrive. Results are committed in batches, each batch in one
+# transaction, and whatever is pending is committed on flush() or when the with block exits, even on an error.
+# So every result is written once, and a run that stops halfway keeps everything fetched up to the last batch.
+class CacheWriter:
+    def __init__(self, cache, batch_size=WRITE_BATCH_SIZE, batch_seconds=WRITE_BATCH_SECONDS):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.pending = []
+        self.count = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    # expire is in seconds, None to keep the entry until it is evicted
+    def set(self, key, value, expire=None):
+        with self.lock:
+            self.pending.append((key, value, expire))
+            self.count += 1
+            due = len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.batch_seconds
+        if due:
+            self.flush()
+
+    # Value of a result that is waiting to be committed, or default
+    def get(self, key, default=None):
+        with self.lock:
+            for pending_key, value, _ in reversed(self.pending):
+                if pending_key == key:
+                    return value
+        return default
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.last_flush = time.monotonic()
+        if pending:
+            with self.cache.transact():
+                for key, value, expire in pending:
+                    self.cache.set(key, value, expire=expire)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+# Bounded in-memory LRU tier in front of a persistent diskcache store. Recently used entries are served from
+# memory; the least recently used are dropped past maxsize, and entries older than ttl seconds are re-read from
+# the store, or sooner if the entry expires sooner. Writes go to both tiers. Hit and miss counts cover both tiers,
+# and are counted here rather than by diskcache, which would turn every read into a write.
+class TieredCache:
+    def __init__(self, store, maxsize=INFO_MEMORY_CACHE_SIZE, ttl=INFO_MEMORY_CACHE_TTL):
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key -> (expires at, value)
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        # Counts already added to the store by save_stats()
+        self.saved_hits = 0
+        self.saved_misses = 0
+        self.lock = threading.RLock()
+
+    def _remember(self, key, value, expire=None):
+        ttl = self.ttl if expire is None else min(self.ttl, expire)
+        self.memory[key] = (time.monotonic() + ttl, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def _from_memory(self, key):
+        entry = self.memory.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.memory[key]
+            return None
+        self.memory.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._from_memory(key)
+            if entry is not None:
+                self.memory_hits += 1
+                return entry[1]
+        value, expire_time = self.store.get(key, default=_MISSING, expire_time=True)
+        with self.lock:
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.store_hits += 1
+            self._remember(key, value, None if expire_time is None else max(0, expire_time - time.time()))
+        return value
+
+    # Checks for a key without loading its value into memory
+    def __contains__(self, key):
+        with self.lock:
+            if self._from_memory(key) is not None:
+                self.memory_hits += 1
+                return True
+        found = key in self.store
+        with self.lock:
+            if found:
+                self.store_hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def set(self, key, value, expire=None):
+        self.store.set(key, value, expire=expire)
+        with self.lock:
+            self._remember(key, value, expire)
+
+    def transact(self):
+        return self.store.transact()
+
+    def clear_memory(self):
+        with self.lock:
+            self.memory.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_entries": len(self.memory),
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+            }
+
+    # Adds the hits and misses counted since the last call to the totals kept in the store
+    def save_stats(self):
+        with self.lock:
+            hits = self.memory_hits + self.store_hits
+            new_hits, new_misses = hits - self.saved_hits, self.misses - self.saved_misses
+            self.saved_hits, self.saved_misses = hits, self.misses
+        if new_hits or new_misses:
+            with self.store.transact():
+                self.store.incr(_HITS_KEY, new_hits)
+                self.store.incr(_MISSES_KEY, new_misses)
+
+
+# Opens a cache directory with a size limit and eviction policy, by default those set in definitions
+def open_cache(directory, size_limit=INFO_CACHE_SIZE, eviction_policy=INFO_CACHE_EVICTION):
+    return Cache(directory, size_limit=size_limit, eviction_policy=eviction_policy)
+
+
+def _read_only_db(cache):
+    return sqlite3.connect(f"{(Path(cache.directory) / 'cache.db').resolve().as_uri()}?mode=ro", uri=True)
+
+
+# Returns entries, bytes on disk, taxa info hit and miss counts saved by TieredCache, and how many entries have
+# expired but not been removed yet
+def cache_stats(cache):
+    hits, misses = cache.get(_HITS_KEY, 0), cache.get(_MISSES_KEY, 0)
+    db = _read_only_db(cache)
+    try:
+        expired = db.execute("SELECT COUNT(*) FROM Cache WHERE expire_time IS NOT NULL AND expire_time < ?",
+                             (time.time(),)).fetchone()[0]
+    finally:
+        db.close()
+    return {
+        "entries": len(cache),
+        "bytes": cache.volume(),
+        "size_limit": cache.size_limit,
+        "eviction_policy": cache.eviction_policy,
+        "hits": hits,
+        "misses": misses,
+        "expired": expired,
+    }
+
+
+# Removes expired entries, evicts down to the size limit, and gives the freed space back to the file system.
+# Returns the number of entries removed
+def compact_cache(cache):
+    removed = cache.expire() + cache.cull()
+    db = sqlite3.connect(Path(cache.directory) / "cache.db")
+    try:
+        db.execute("VACUUM")
+    finally:
+        db.close()
+    return removed
+
+
+# Moves the entries of a legacy info.json file ({taxon: summary}) into the cache, once per file, in one
+# transaction. Entries already in the cache are kept. The file itself is left alone.
+# Returns the number of entries added
+def migrate_legacy_info(cache, json_path):
+    json_path = os.path.abspath(json_path)
+    if not os.path.isfile(json_path) or (_MIGRATED_KEY, json_path) in cache:
+        return 0
+    with open(json_path, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+
+    count = 0
+    with cache.transact():
+        for taxon, summary in legacy.items():
+            entry = info_entry(summary)
+            if entry is not None and cache.add(taxon, entry, expire=STATUS_TTL[entry[0]]):
+                count += 1
+        cache.set((_MIGRATED_KEY, json_path), True)
+    return count
+
+
+def main():
+    parser = ArgumentParser(prog="phylo-match-cache", description="Inspect and maintain a phylo-match cache directory")
+    parser.add_argument("--cache", default=os.path.join(os.path.expanduser("~"), "phylo-match-cache"),
+                        help="cache directory (default: ~/phylo-match-cache)")
+    parser.add_argument("--size-limit", type=int, default=INFO_CACHE_SIZE,
+                        help="most bytes the cache may use (default: PHYLO_MATCH_CACHE_SIZE or 1 GiB)")
+    parser.add_argument("--eviction-policy", default=INFO_CACHE_EVICTION,
+                        choices=["least-recently-stored", "least-recently-used", "least-frequently-used", "none"],
+                        help="which entries are removed first past the size limit "
+                             "(default: PHYLO_MATCH_CACHE_EVICTION or least-recently-stored)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="show entries, size, hit and miss counts and expired entries")
+    commands.add_parser("compact", help="remove expired entries, evict down to the size limit and vacuum")
+    migrate = commands.add_parser("migrate", help="move a legacy info.json file into the cache")
+    migrate.add_argument("json", help="info.json file to move in")
+
+    args = parser.parse_args()
+    with open_cache(args.cache, args.size_limit, args.eviction_policy) as cache:
+        if args.command == "stats":
+            for key, value in cache_stats(cache).items():
+                print(f"{key}: {value}")
+        elif args.command == "compact":
+            before = cache.volume()
+            removed = compact_cache(cache)
+            print(f"Removed {removed} entries, {before} -> {cache.volume()} bytes")
+        else:
+            count = migrate_legacy_info(cache, args.json)
+            print(f"Moved {count} taxa from {args.json} into {args.cache}")
+
+
+if __name__ == '__main__':
+    main()
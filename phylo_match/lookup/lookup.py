@@ -0,0 +1,320 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from phylo_match.definitions.definitions import WIKI_API, LOOKUP_CONCURRENCY, INFO_FOUND_TTL, INFO_ABSENT_TTL, \
+    INFO_AMBIGUOUS_TTL, INFO_TRANSIENT_TTL, THUMBNAIL_SIZE
+
+USER_AGENT = "phylo-match (https://github.com/spearw/phylo-match)"
+NO_INFO = "No Info"
+
+# Lookup outcomes. Info is cached as (status, summary), each status for its own time
+FOUND = "found"
+ABSENT = "absent"
+AMBIGUOUS = "ambiguous"
+TRANSIENT = "transient"
+STATUS_TTL = {
+    FOUND: INFO_FOUND_TTL,
+    ABSENT: INFO_ABSENT_TTL,
+    AMBIGUOUS: INFO_AMBIGUOUS_TTL,
+    TRANSIENT: INFO_TRANSIENT_TTL,
+}
+
+# Titles per extracts request. The API returns at most 20 intro extracts per response
+EXTRACT_BATCH_SIZE = 20
+# Titles per pageimages request, the most the API allows
+THUMBNAIL_BATCH_SIZE = 50
+
+# HTTP statuses worth retrying: rate limiting and server-side failures
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Maps each title asked for to the title of the page the API answered with, following normalization then
+# redirects. renamed holds the API's "from" -> "to" steps; the seen set guards against redirect loops
+def _page_titles(titles, renamed):
+    page_titles = {}
+    for title in titles:
+        page_title = title
+        seen = set()
+        while page_title in renamed and page_title not in seen:
+            seen.add(page_title)
+            page_title = renamed[page_title]
+        page_titles[title] = page_title
+    return page_titles
+
+
+# Reads a cached info value as (status, summary), or None if the taxon should be looked up.
+# Plain strings were cached before lookups had a status. A plain "No Info" may have been a failed request,
+# so it is looked up again
+def info_entry(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return None if value == NO_INFO else (FOUND, value)
+    return tuple(value)
+
+
+# Fetches taxon summaries from a MediaWiki API. Requests run concurrently under an asyncio event loop, bounded by
+# `concurrency`, and share one keep-alive requests.Session whose connection pool is sized to match, so
+# connections are reused across lookups. Titles are looked up in batches, one request per batch.
+# Failed requests are retried with exponential backoff.
+# endpoint can point at any MediaWiki-compatible API, e.g. a local stand-in server for testing.
+class WikiLookup:
+    def __init__(self, endpoint=WIKI_API, concurrency=LOOKUP_CONCURRENCY, timeout=10, retries=3, backoff=0.5,
+                 sentences=10, batch_size=EXTRACT_BATCH_SIZE):
+        self.endpoint = endpoint
+        self.batch_size = max(1, int(batch_size))
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sentences = sentences
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # requests is blocking, so each request runs on one of these threads while the event loop waits on it
+        self.executor = ThreadPoolExecutor(self.concurrency)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, params):
+        params = dict(params, format="json", formatversion=2)
+        response = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+        if response.status_code in RETRY_STATUSES:
+            raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+        response.raise_for_status()
+        return response.json()
+
+    def _download(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        if response.status_code in RETRY_STATUSES:
+            raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+        response.raise_for_status()
+        return response.content
+
+    # Runs one API request off the event loop
+    async def _get(self, semaphore, params):
+        return await self._call(semaphore, self._request, params)
+
+    # Runs a blocking request off the event loop, retrying connection errors, timeouts and retryable statuses
+    async def _call(self, semaphore, request, *args):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                async with semaphore:
+                    return await loop.run_in_executor(self.executor, request, *args)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                status = e.response.status_code if getattr(e, "response", None) is not None else None
+                if attempt >= self.retries or (status is not None and status not in RETRY_STATUSES):
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+                attempt += 1
+
+    def _extract_params(self, titles):
+        return {
+            "action": "query",
+            "prop": "extracts|pageprops",
+            "ppprop": "disambiguation",
+            "explaintext": 1,
+            # Several extracts per request are only allowed for the intro section
+            "exintro": 1,
+            "exsentences": self.sentences,
+            "exlimit": "max",
+            "redirects": 1,
+            "titles": "|".join(titles),
+        }
+
+    # Returns {title: (status, extract)} for a batch of titles, in one request (plus continuations if the API
+    # splits the response). Normalized and redirected titles are mapped back to the titles asked for. Titles
+    # with no page, or a page with no text, are ABSENT; disambiguation pages are AMBIGUOUS.
+    async def _extract_batch(self, semaphore, titles):
+        params = self._extract_params(titles)
+        renamed = {}
+        extracts = {}
+        while True:
+            data = await self._get(semaphore, params)
+            query = data.get("query", {})
+            for step in query.get("normalized", []) + query.get("redirects", []):
+                renamed[step["from"]] = step["to"]
+            for page in query.get("pages", []):
+                if "disambiguation" in page.get("pageprops", {}):
+                    extracts[page["title"]] = (AMBIGUOUS, None)
+                elif page.get("extract"):
+                    extracts[page["title"]] = (FOUND, page["extract"])
+                # Extracts can arrive in a later continuation than their page
+                elif page.get("title") not in extracts:
+                    extracts[page.get("title")] = (ABSENT, None)
+            if "continue" not in data:
+                break
+            params = dict(self._extract_params(titles), **data["continue"])
+
+        page_titles = _page_titles(titles, renamed)
+        return {title: extracts.get(page_titles[title], (ABSENT, None)) for title in titles}
+
+    async def _search(self, semaphore, term):
+        data = await self._get(semaphore, {"action": "query", "list": "search", "srsearch": term, "srlimit": 1,
+                                           "srprop": ""})
+        results = data.get("query", {}).get("search", [])
+        return results[0]["title"] if results else None
+
+    # Summaries for one batch of taxa: one request for the whole batch, then a search for each title that has
+    # no page of its own, and one more batched request for the pages those searches found.
+    # Requests that fail after their retries make the titles they were for TRANSIENT
+    async def _summary_batch(self, semaphore, titles, on_result):
+        try:
+            extracts = await self._extract_batch(semaphore, titles)
+        except (requests.RequestException, ValueError):
+            extracts = dict.fromkeys(titles, (TRANSIENT, None))
+
+        missing = [title for title in titles if extracts[title][0] in (ABSENT, AMBIGUOUS)]
+        if missing:
+            searches = await asyncio.gather(*(self._search(semaphore, title) for title in missing),
+                                            return_exceptions=True)
+            found = {}
+            for title, result in zip(missing, searches):
+                if isinstance(result, Exception):
+                    extracts[title] = (TRANSIENT, None)
+                elif result is not None and result != title:
+                    found[title] = result
+            if found:
+                try:
+                    found_extracts = await self._extract_batch(semaphore, list(dict.fromkeys(found.values())))
+                except (requests.RequestException, ValueError):
+                    found_extracts = dict.fromkeys(found.values(), (TRANSIENT, None))
+                for title, found_title in found.items():
+                    # A search hit that is itself missing or ambiguous leaves the original answer
+                    if found_extracts[found_title][0] in (FOUND, TRANSIENT):
+                        extracts[title] = found_extracts[found_title]
+
+        results = {}
+        for title in titles:
+            status, extract = extracts[title]
+            results[title] = (status, extract or NO_INFO)
+            if on_result:
+                on_result(title, status, results[title][1])
+        return results
+
+    async def _summaries(self, titles, on_result):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batches = [titles[i:i + self.batch_size] for i in range(0, len(titles), self.batch_size)]
+        results = {}
+        for batch_results in await asyncio.gather(*(self._summary_batch(semaphore, batch, on_result)
+                                                    for batch in batches)):
+            results.update(batch_results)
+        return results
+
+    # Returns {title: (status, summary)} for every title. on_result(title, status, summary) is called as each
+    # one arrives. Titles that are not FOUND get "No Info" as their summary.
+    def fetch(self, titles, on_result=None):
+        titles = list(dict.fromkeys(titles))
+        if not titles:
+            return {}
+        return asyncio.run(self._summaries(titles, on_result))
+
+    # Returns {title: thumbnail url} for a batch of titles, in one request (plus continuations). Titles whose
+    # page has no image, or that have no page, map to None
+    async def _thumbnail_batch(self, semaphore, titles, size):
+        params = {
+            "action": "query",
+            "prop": "pageimages",
+            "piprop": "thumbnail",
+            "pithumbsize": size,
+            "pilimit": "max",
+            "redirects": 1,
+            "titles": "|".join(titles),
+        }
+        renamed = {}
+        urls = {}
+        while True:
+            data = await self._get(semaphore, params)
+            query = data.get("query", {})
+            for step in query.get("normalized", []) + query.get("redirects", []):
+                renamed[step["from"]] = step["to"]
+            for page in query.get("pages", []):
+                if "thumbnail" in page:
+                    urls[page["title"]] = page["thumbnail"]["source"]
+            if "continue" not in data:
+                break
+            params = dict(params, **data["continue"])
+
+        page_titles = _page_titles(titles, renamed)
+        return {title: urls.get(page_titles[title]) for title in titles}
+
+    # Thumbnails for one batch of taxa: one request for their urls, then every image downloaded at once
+    async def _thumbnail_images(self, semaphore, titles, size, on_result):
+        try:
+            urls = await self._thumbnail_batch(semaphore, titles, size)
+        except (requests.RequestException, ValueError):
+            urls = {}
+            statuses = dict.fromkeys(titles, TRANSIENT)
+        else:
+            statuses = {title: FOUND if urls[title] else ABSENT for title in titles}
+
+        found = [title for title in titles if statuses[title] == FOUND]
+        downloads = await asyncio.gather(*(self._call(semaphore, self._download, urls[title]) for title in found),
+                                         return_exceptions=True)
+        images = {}
+        for title, image in zip(found, downloads):
+            if isinstance(image, Exception):
+                statuses[title] = TRANSIENT
+            else:
+                images[title] = image
+
+        results = {}
+        for title in titles:
+            results[title] = (statuses[title], images.get(title, b""))
+            if on_result:
+                on_result(title, *results[title])
+        return results
+
+    async def _thumbnails(self, titles, size, on_result):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batches = [titles[i:i + THUMBNAIL_BATCH_SIZE] for i in range(0, len(titles), THUMBNAIL_BATCH_SIZE)]
+        results = {}
+        for batch_results in await asyncio.gather(*(self._thumbnail_images(semaphore, batch, size, on_result)
+                                                    for batch in batches)):
+            results.update(batch_results)
+        return results
+
+    # Returns {title: (status, image bytes)} with a thumbnail at most size pixels wide for every title.
+    # Thumbnails are scaled down by the server, so only small images are downloaded. on_result(title, status,
+    # image) is called as each one arrives. Titles that are not FOUND get empty bytes.
+    def fetch_thumbnails(self, titles, size=THUMBNAIL_SIZE, on_result=None):
+        titles = list(dict.fromkeys(titles))
+        if not titles:
+            return {}
+        return asyncio.run(self._thumbnails(titles, size, on_result))
@@ -0,0 +1,156 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sqlite3
+import time
+import zlib
+from argparse import ArgumentParser
+from pathlib import Path
+
+from phylo_match.definitions.definitions import WIKI_API, LOOKUP_CONCURRENCY
+from phylo_match.lookup.cache import open_cache
+from phylo_match.lookup.lookup import WikiLookup, TRANSIENT, STATUS_TTL
+from phylo_match.match.index import tree_hash
+from phylo_match.match.match import read_tree_file
+
+# Offline cache packs hold taxon info for a whole tree in one SQLite file, one zlib-compressed row per taxon,
+# so a machine with internet access can download once and other machines can warm their cache from the file
+PACK_FORMAT_VERSION = 1
+# Rows written per transaction while prefetching
+PACK_BATCH_SIZE = 200
+
+
+def _open_pack(pack_path):
+    db = sqlite3.connect(pack_path)
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS info (taxon TEXT PRIMARY KEY, status TEXT, summary BLOB) WITHOUT ROWID")
+    with db:
+        db.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)", (str(PACK_FORMAT_VERSION),))
+    return db
+
+
+def _pack(value):
+    return zlib.compress(value.encode("utf-8"), 9)
+
+
+def _unpack(blob):
+    return zlib.decompress(blob).decode("utf-8")
+
+
+# Downloads info for every taxon in a tree into a pack file. Taxa already in the pack are skipped,
+# so an interrupted prefetch can be re-run to finish. Failed lookups are left out of the pack, so a re-run
+# retries them. Returns the number of taxa downloaded.
+def build_pack(tree_path, pack_path, endpoint=WIKI_API, concurrency=LOOKUP_CONCURRENCY, on_progress=None):
+    taxa = read_tree_file(tree_path)
+    db = _open_pack(pack_path)
+    try:
+        have = set(row[0] for row in db.execute("SELECT taxon FROM info"))
+        missing = [taxon for taxon in dict.fromkeys(taxa) if taxon not in have]
+
+        pending = []
+
+        def flush():
+            with db:
+                db.executemany("INSERT OR REPLACE INTO info (taxon, status, summary) VALUES (?, ?, ?)", pending)
+            pending.clear()
+
+        def on_result(taxon, status, summary):
+            if status != TRANSIENT:
+                pending.append((taxon, status, _pack(summary)))
+            if len(pending) >= PACK_BATCH_SIZE:
+                flush()
+            if on_progress:
+                on_progress(taxon)
+
+        try:
+            with WikiLookup(endpoint, concurrency) as lookup:
+                lookup.fetch(missing, on_result)
+        finally:
+            flush()
+
+        with db:
+            db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                ("tree", os.path.basename(tree_path)),
+                ("tree_hash", tree_hash(taxa)),
+                ("endpoint", endpoint),
+                ("created", time.strftime("%Y-%m-%dT%H:%M:%S")),
+            ])
+        db.execute("VACUUM")
+    finally:
+        db.close()
+
+    return len(missing)
+
+
+# Yields (taxon, status, summary) for every entry in a pack file
+def read_pack(pack_path):
+    if not os.path.isfile(pack_path):
+        raise FileNotFoundError(pack_path)
+    db = sqlite3.connect(f"{Path(pack_path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or int(version[0]) > PACK_FORMAT_VERSION:
+            raise ValueError(f"{pack_path}: unsupported pack version {version[0] if version else None}")
+        for taxon, status, blob in db.execute("SELECT taxon, status, summary FROM info"):
+            yield taxon, status, _unpack(blob)
+    finally:
+        db.close()
+
+
+# Loads every entry of a pack file into a diskcache Cache in one transaction, each expiring after the TTL
+# of its status. Returns the number of entries
+def import_pack(pack_path, cache):
+    count = 0
+    with cache.transact():
+        for taxon, status, summary in read_pack(pack_path):
+            cache.set(taxon, (status, summary), expire=STATUS_TTL[status])
+            count += 1
+    return count
+
+
+def main():
+    parser = ArgumentParser(prog="phylo-match-pack",
+                            description="Prefetch taxon info for a tree into a pack file, or import a pack file "
+                                        "into a phylo-match cache directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prefetch = commands.add_parser("prefetch", help="download info for every taxon in a tree into a pack file")
+    prefetch.add_argument("tree", help="tree file (.nex) or truth database (.csv)")
+    prefetch.add_argument("pack", help="pack file to create or complete")
+    prefetch.add_argument("--endpoint", default=WIKI_API, help="MediaWiki API to download from")
+    prefetch.add_argument("--concurrency", type=int, default=LOOKUP_CONCURRENCY, help="requests in flight at once")
+
+    load = commands.add_parser("import", help="load a pack file into a cache directory")
+    load.add_argument("pack", help="pack file to import")
+    load.add_argument("--cache", default=os.path.join(os.path.expanduser("~"), "phylo-match-cache"),
+                      help="cache directory (default: ~/phylo-match-cache)")
+
+    args = parser.parse_args()
+    if args.command == "prefetch":
+        count = build_pack(args.tree, args.pack, args.endpoint, args.concurrency)
+        print(f"Downloaded {count} taxa into {args.pack}")
+    else:
+        with open_cache(args.cache) as cache:
+            count = import_pack(args.pack, cache)
+        print(f"Imported {count} taxa into {args.cache}")
+
+
+if __name__ == '__main__':
+    main()
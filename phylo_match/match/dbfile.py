@@ -0,0 +1,130 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import csv
+import io
+import os
+import stat
+import tempfile
+
+# Read buffer for DB files. Large reads keep the C csv parser busy instead of waiting on small reads
+BUFFER_SIZE = 1 << 20
+
+
+# Yields (row number, value) for one column of a DB .csv file, skipping the header row.
+# Quoted fields (including commas and line breaks inside quotes) are handled by the csv module,
+# and only the requested column is kept, so memory stays bounded however wide or long the file is.
+# Row numbers count from 1 at the header, like a spreadsheet.
+# Quotes are parsed strictly, and a name can't span lines, so a quote that is never closed is reported at the row
+# where it opened instead of swallowing the rows after it.
+def iter_db_column(path, column_index, skip_header=True):
+    with open(path, 'r', encoding="utf-8", newline="", buffering=BUFFER_SIZE) as f:
+        reader = csv.reader(f, strict=True)
+        row_number = 0
+        while True:
+            start_line = reader.line_num + 1
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                raise ValueError(f"{path}: malformed row {row_number + 1} (line {start_line}): {e}") from e
+            row_number += 1
+
+            if row_number == 1 and skip_header:
+                continue
+            # Blank rows have no fields at all
+            if not row:
+                yield row_number, ""
+                continue
+            if column_index >= len(row):
+                raise ValueError(f"{path}: row {row_number} (line {reader.line_num}) has {len(row)} columns, "
+                                 f"no column {column_index}")
+            value = row[column_index]
+            if "\n" in value or "\r" in value:
+                raise ValueError(f"{path}: row {row_number} (line {start_line}) has a line break in column "
+                                 f"{column_index}; check for a quote that is not closed")
+            yield row_number, value.strip()
+
+
+# Returns the values of one column of a DB .csv file, without the header
+def read_db_column(path, column_index):
+    return [value for _, value in iter_db_column(path, column_index)]
+
+
+# Yields (raw text, parsed row) for each record of an open DB file. The raw text is exactly what was read,
+# line breaks included, so records can be copied to another file unchanged.
+def _iter_raw_records(f):
+    raw_lines = []
+
+    def lines():
+        for line in f:
+            raw_lines.append(line)
+            yield line
+
+    for row in csv.reader(lines()):
+        raw = "".join(raw_lines)
+        raw_lines.clear()
+        yield raw, row
+
+
+# Replaces one field of a raw record, leaving every other byte as it was
+def _replace_field(raw, row, column_index, value):
+    body = raw.rstrip("\r\n")
+    line_ending = raw[len(body):]
+    if '"' not in body and "\n" not in body:
+        fields = body.split(",")
+        fields[column_index] = value
+        return ",".join(fields) + line_ending
+    # Quoted fields: re-serialize this record only
+    row = list(row)
+    row[column_index] = value
+    out = io.StringIO()
+    csv.writer(out, lineterminator=line_ending or "\n").writerow(row)
+    return out.getvalue()
+
+
+# Writes a copy of a DB .csv file with names in one column replaced according to replacements (old -> new).
+# Records that are not replaced are copied byte for byte. The copy is written to a temporary file next to
+# outfile_path and renamed into place, so outfile_path never holds a partly written file.
+def rewrite_db_column(path, outfile_path, column_index, replacements):
+    out_dir = os.path.dirname(os.path.abspath(outfile_path))
+    tmp = tempfile.NamedTemporaryFile('w', encoding="utf-8", newline="", buffering=BUFFER_SIZE, dir=out_dir,
+                                      prefix=".phylo-match-", suffix=".tmp", delete=False)
+    try:
+        # Temporary files are private; give the copy the same permissions as the original
+        os.chmod(tmp.name, stat.S_IMODE(os.stat(path).st_mode))
+        with open(path, 'r', encoding="utf-8", newline="", buffering=BUFFER_SIZE) as f, tmp:
+            records = _iter_raw_records(f)
+            # Header is never rewritten
+            for raw, _ in records:
+                tmp.write(raw)
+                break
+            for raw, row in records:
+                if column_index < len(row):
+                    new_name = replacements.get(row[column_index].strip())
+                    if new_name:
+                        raw = _replace_field(raw, row, column_index, new_name)
+                tmp.write(raw)
+        os.replace(tmp.name, outfile_path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+    return outfile_path
@@ -0,0 +1,185 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+from collections import defaultdict
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import extract
+
+
+# Returns the positions of the names within max_distance of query. The whole block is scored in one
+# C-level call with a cutoff, so each comparison stops as soon as it is known to exceed max_distance.
+def within_distance(query, names, max_distance):
+    if max_distance < 0 or not names:
+        return []
+    results = extract(query, names, scorer=Levenshtein.distance, processor=None,
+                      score_cutoff=max_distance, limit=None)
+    return [position for _, _, position in results]
+
+
+# Finds every indexed name within a given levenshtein distance of a query without comparing against all names.
+# Each name is cut into (max_distance + 1) pieces. k edits can touch at most k pieces, so any string within
+# k edits still contains one of the pieces verbatim, shifted by at most k characters. Only names sharing such a
+# piece are scored, so lookups cost scale with the number of real candidates.
+class NameIndex:
+    def __init__(self, names, max_distance):
+        self.max_distance = max(int(max_distance), 0)
+        self.names = list(dict.fromkeys(names))
+        self.lengths = [len(name) for name in self.names]
+
+        # piece -> [(name id, offset of piece in name)]
+        self.pieces = defaultdict(list)
+        self.piece_lengths = set()
+        # Names too short to be cut into non-empty pieces are always candidates
+        self.short_names = []
+
+        num_pieces = self.max_distance + 1
+        for i, name in enumerate(self.names):
+            length = len(name)
+            if length < num_pieces:
+                self.short_names.append(i)
+                continue
+            bounds = [j * length // num_pieces for j in range(num_pieces + 1)]
+            for j in range(num_pieces):
+                piece = name[bounds[j]:bounds[j + 1]]
+                self.pieces[piece].append((i, bounds[j]))
+                self.piece_lengths.add(len(piece))
+        self.piece_lengths = sorted(self.piece_lengths)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Returns the ids of names whose levenshtein distance to query is at most max_distance
+    def search_ids(self, query, max_distance):
+        if max_distance < 0:
+            return set()
+        if max_distance > self.max_distance:
+            raise ValueError(f"index built for distance {self.max_distance}, cannot search at {max_distance}")
+
+        query_length = len(query)
+        lengths = self.lengths
+        found = set(i for i in self.short_names if abs(lengths[i] - query_length) <= max_distance)
+
+        for piece_length in self.piece_lengths:
+            for start in range(query_length - piece_length + 1):
+                hits = self.pieces.get(query[start:start + piece_length])
+                if not hits:
+                    continue
+                for i, offset in hits:
+                    if abs(offset - start) <= max_distance and abs(lengths[i] - query_length) <= max_distance:
+                        found.add(i)
+
+        found = list(found)
+        block = [self.names[i] for i in found]
+        return set(found[position] for position in within_distance(query, block, max_distance))
+
+    # Returns the set of names within max_distance of query
+    def search(self, query, max_distance):
+        return set(self.names[i] for i in self.search_ids(query, max_distance))
+
+
+# Splits a taxon name into genus and epithet. Names without the separator have an empty epithet.
+def split_name(name, separator="_"):
+    parts = name.split(separator, 1)
+    if len(parts) == 1:
+        return parts[0], ""
+    return parts[0], parts[1]
+
+
+# Content hash of a tree's names. Cached match results and compiled indexes are keyed by it
+def tree_hash(tree):
+    if isinstance(tree, TreeIndex):
+        return tree.content_hash
+    return hashlib.sha256("\n".join(tree).encode("utf-8")).hexdigest()
+
+
+# Everything match() needs to know about a tree, computed once per tree instead of once per DB entry.
+# Positions refer to the order of names in the tree, so suggestions keep the tree's ordering.
+class TreeIndex:
+    def __init__(self, tree, separator="_", levenshtein_num=4):
+        self.names = list(tree)
+        self.separator = separator
+        self.difference_threshold = int(levenshtein_num)
+        self.content_hash = tree_hash(self.names)
+
+        self.parts = []
+        self.name_positions = defaultdict(list)
+        self.genus_positions = defaultdict(list)
+        self.epithet_positions = defaultdict(list)
+        for position, name in enumerate(self.names):
+            genus, epithet = split_name(name, separator)
+            self.parts.append((genus, epithet))
+            self.name_positions[name].append(position)
+            self.genus_positions[genus].append(position)
+            self.epithet_positions[epithet].append(position)
+
+        # Fuzzy indexes over full names, and over the distinct genera and epithets for the loose passes
+        self.name_index = NameIndex(self.name_positions, self.difference_threshold - 1)
+        self.genus_index = NameIndex(self.genus_positions, self.difference_threshold - 2)
+        self.epithet_index = NameIndex(self.epithet_positions, self.difference_threshold - 2)
+
+    def __contains__(self, name):
+        return name in self.name_positions
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    # True if this index was built with the given match settings
+    def built_for(self, separator, levenshtein_num):
+        return self.separator == separator and self.difference_threshold == int(levenshtein_num)
+
+    def _positions(self, keys, positions):
+        found = set()
+        for key in keys:
+            found.update(positions[key])
+        return found
+
+    # Returns (suggestions, species_match, genus_match, loose_suggestions) for a name that is not in the tree.
+    # Every tree name lands in the first category it qualifies for, in order: similar name, same genus,
+    # similar genus, same epithet, similar epithet.
+    def suggest(self, name, genus, epithet):
+        similar = self._positions(self.name_index.search(name, self.difference_threshold - 1), self.name_positions)
+        same_genus = set(self.genus_positions.get(genus, ()))
+        similar_genus = self._positions(self.genus_index.search(genus, self.difference_threshold - 2),
+                                        self.genus_positions)
+        same_epithet = set(self.epithet_positions.get(epithet, ()))
+        similar_epithet = self._positions(self.epithet_index.search(epithet, self.difference_threshold - 2),
+                                          self.epithet_positions)
+
+        suggestions = []
+        species_match = []
+        genus_match = []
+        loose_suggestions = []
+        for position in sorted(similar | same_genus | similar_genus | same_epithet | similar_epithet):
+            tree_name = self.names[position]
+            if position in similar:
+                suggestions.append(tree_name)
+            elif position in same_genus:
+                genus_match.append(tree_name)
+            elif position in similar_genus:
+                loose_suggestions.append(tree_name)
+            elif position in same_epithet:
+                species_match.append(tree_name)
+            else:
+                loose_suggestions.append(tree_name)
+
+        return suggestions, species_match, genus_match, loose_suggestions
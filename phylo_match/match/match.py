@@ -25,75 +25,148 @@ import json
 from pathlib import Path
 import time
 import multiprocessing
-from Levenshtein import distance as levenshtein_distance
-from functools import lru_cache
-
-
-def match(dbs, tree, db_separator="_", levenshtein_num=4):
-
-    output = []
-    perfect_matches = []
-    difference_threshold = int(levenshtein_num)
-    for db in dbs:
-        for db_name in db:
-            suggestions = []
-            loose_suggestions = []
-            genus_match = []
-            species_match = []
-            genus_name = db_name.split(db_separator, 1)[0]
-            try:
-                species_name = db_name.split(db_separator, 1)[1]
-            except:
-                species_name = ""
-                print(f"WARNING: entry [{db_name}] possibly malformed. Check database.")
-
-            found_match = False
-            for tree_name in tree:
-
-                loose_suggestion = False
-
-                tree_genus_name = tree_name.split(db_separator, 1)[0]
-                try:
-                    tree_species_name = tree_name.split(db_separator, 1)[1]
-                except:
-                    tree_species_name = ""
-                    print(f"WARNING: tree entry [{tree_name}] possibly malformed. Check tree.")
-
-                if db_name == tree_name:
-                    found_match = True
-                    break
-                # Match by similarity
-                elif levenshtein_distance(db_name, tree_name) < difference_threshold:
-                    suggestions.append(tree_name)
-                # Match by genus
-                elif genus_name == tree_genus_name:
-                    genus_match.append(tree_name)
-                # Match by similarity (genus only)
-                elif levenshtein_distance(genus_name, tree_genus_name) < (difference_threshold - 1):
-                    loose_suggestions.append(tree_name)
-                # Match by species
-                elif species_name == tree_species_name:
-                    species_match.append(tree_name)
-                # Match by similarity (species only)
-                elif levenshtein_distance(species_name, tree_species_name) < (difference_threshold - 1):
-                    loose_suggestions.append(tree_name)
-
-            # If suggestions is empty, add loose suggestions (levenshtein applied to genus and species independently)
-            if len(suggestions) == 0 and len(loose_suggestions) > 0:
-                suggestions = suggestions + loose_suggestions
-                loose_suggestion = True
-            if found_match:
-                output.append(db_name)
-                perfect_matches.append(db_name)
-            else:
-                output.append([db_name, suggestions, species_match, genus_match, loose_suggestion])
+import hashlib
+import pickle
+import copy
+from phylo_match.match.index import TreeIndex, split_name, tree_hash
+from phylo_match.match.nexus import read_nexus_taxa
+from phylo_match.match.dbfile import read_db_column, rewrite_db_column
+from phylo_match.lookup.lookup import WikiLookup, info_entry, NO_INFO, FOUND, ABSENT, AMBIGUOUS, TRANSIENT, \
+    STATUS_TTL
+from phylo_match.lookup.cache import open_cache, migrate_legacy_info
+from phylo_match.definitions.definitions import WIKI_API, LOOKUP_CONCURRENCY
+
+
+# Matches a single DB entry against the tree. Returns the name itself for a perfect match,
+# otherwise [db_name, suggestions, species_match, genus_match, loose_suggestion].
+# Malformed names are reported by validate() before matching, not here
+def match_name(tree_index, db_name):
+    db_separator = tree_index.separator
+    if db_name in tree_index:
+        return db_name
+
+    genus_name, species_name = split_name(db_name, db_separator)
+    suggestions, species_match, genus_match, loose_suggestions = tree_index.suggest(db_name, genus_name, species_name)
+
+    # If suggestions is empty, add loose suggestions (levenshtein applied to genus and species independently)
+    loose_suggestion = False
+    if len(suggestions) == 0 and len(loose_suggestions) > 0:
+        suggestions = suggestions + loose_suggestions
+        loose_suggestion = True
+    return [db_name, suggestions, species_match, genus_match, loose_suggestion]
+
+
+# Tree index of the current worker process, set once by the pool initializer
+_worker_tree_index = None
+
+
+def _init_match_worker(tree_index):
+    global _worker_tree_index
+    _worker_tree_index = tree_index
+
+
+def _match_shard(db_names):
+    return [match_name(_worker_tree_index, db_name) for db_name in db_names]
+
+
+# Number of new results held before they are written to the cache in one transaction
+CACHE_BATCH_SIZE = 500
+
+# Bump when match_name's results or their format change, so results cached by older versions are matched again
+MATCH_CACHE_VERSION = 1
+
+
+# Yields (db_name, result) for each name as soon as it is matched
+def _iter_match_names(db_names, tree, db_separator, levenshtein_num, workers):
+    if not db_names:
+        return
+
+    # Built once, so each entry is matched by lookups instead of a pass over the whole tree
+    if isinstance(tree, TreeIndex) and tree.built_for(db_separator, levenshtein_num):
+        tree_index = tree
+    else:
+        tree_index = TreeIndex(tree, db_separator, levenshtein_num)
+
+    if workers > 1 and len(db_names) > 1:
+        # Several small shards per worker keeps them all busy and lets the first results arrive early.
+        # The tree index reaches each worker once through the initializer (inherited on fork), not with every shard
+        shard_size = max(1, min(256, -(-len(db_names) // (workers * 4))))
+        shards = [db_names[i:i + shard_size] for i in range(0, len(db_names), shard_size)]
+        with multiprocessing.Pool(workers, initializer=_init_match_worker, initargs=(tree_index,)) as p:
+            for shard_names, shard in zip(shards, p.imap(_match_shard, shards)):
+                yield from zip(shard_names, shard)
+    else:
+        for db_name in db_names:
+            yield db_name, match_name(tree_index, db_name)
+
+
+# Generator version of match(). Yields one result per DB entry, in DB order, as soon as it is available,
+# so results can be reviewed while the rest are still being matched. tree is a list of names or a prebuilt TreeIndex.
+# If a diskcache Cache is given, results are stored per DB name (keyed by cache version, tree content, separator
+# and threshold)
+# and only names without a stored result are matched.
+# Every result is yielded as a copy of its own, so callers can edit the suggestion lists without changing
+# repeats of the same name or what is written to the cache.
+def iter_match(dbs, tree, db_separator="_", levenshtein_num=4, workers=1, cache=None):
+
+    db_names = [db_name for db in dbs for db_name in db]
+    unique_names = list(dict.fromkeys(db_names))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    results = {}
+    if cache is not None:
+        key_prefix = ("match", MATCH_CACHE_VERSION, tree_hash(tree), db_separator, int(levenshtein_num))
+        for db_name in unique_names:
+            result = cache.get(key_prefix + (db_name,))
+            if result is not None:
+                results[db_name] = result
+
+    missing_names = [db_name for db_name in unique_names if db_name not in results]
+    new_results = _iter_match_names(missing_names, tree, db_separator, levenshtein_num, workers)
+    uncached = []
+
+    def flush():
+        if cache is not None and uncached:
+            with cache.transact():
+                for db_name, result in uncached:
+                    cache.set(key_prefix + (db_name,), result)
+        uncached.clear()
+
+    try:
+        for db_name in db_names:
+            while db_name not in results:
+                new_name, result = next(new_results)
+                results[new_name] = result
+                uncached.append((new_name, result))
+                if len(uncached) >= CACHE_BATCH_SIZE:
+                    flush()
+
+            result = results[db_name]
+            yield result if type(result) is str else copy.deepcopy(result)
+    finally:
+        new_results.close()
+        flush()
+
+
+# Matches every DB entry against the tree. See iter_match for the caching behaviour
+def match(dbs, tree, db_separator="_", levenshtein_num=4, workers=1, cache=None):
+
+    output = list(iter_match(dbs, tree, db_separator, levenshtein_num, workers, cache))
+    perfect_matches = [result for result in output if type(result) is str]
 
     return output, perfect_matches
 
 
-def read_files(db_path, tree_path, species_name_index):
+# DB entries that appear in the tree as-is. Needs no matching, so it is known before any results are computed
+def find_perfect_matches(dbs, tree):
+    tree_names = set(tree)
+    return [db_name for db in dbs for db_name in db if db_name in tree_names]
+
+
+def read_dbs(db_path, species_name_index):
     dbs = []
-    trees = []
     filenames = []
     if os.path.isdir(db_path):
         filenames = os.listdir(db_path)
@@ -103,17 +176,26 @@ def read_files(db_path, tree_path, species_name_index):
 
     for filename in filenames:
         if not filename.startswith('.'):
-            with open(os.path.join(db_path, filename), 'r', encoding="utf-8") as f:  # open in readonly mode
-                db = []
-                for line in f:
-                    # Get name for every line
-                    name = line.split(",")[species_name_index]
-                    db.append(name.strip())
+            dbs.append(read_db_column(os.path.join(db_path, filename), species_name_index))
+
+    return dbs
+
+
+def read_tree_file(tree_path):
+    fname = os.path.basename(tree_path)
+    tree = []
+    # .nex file read
+    if fname.endswith(('.nex', '.nexus')):
+        tree = read_nexus_taxa(tree_path)
+    # .csv (truth db) file read
+    elif fname.endswith('.csv'):
+        tree = read_db_column(tree_path, 0)
+
+    return tree
 
-                # Remove first line of db (info line)
-                db.pop(0)
-                dbs.append(db)
 
+def read_trees(tree_path):
+    trees = []
     filenames = []
     if os.path.isdir(tree_path):
         filenames = os.listdir(tree_path)
@@ -123,62 +205,89 @@ def read_files(db_path, tree_path, species_name_index):
 
     for filename in filenames:
         if not filename.startswith('.'):
-            with open(os.path.join(tree_path, filename), 'r', encoding="utf-8") as f:  # open in readonly mode
-                fname = os.path.basename(f.name)
-                tree = []
-                copy = False
-                # .nex file read
-                if fname.endswith('.nex'):
-                    for line in f:
-                        if line.strip().upper() == "TAXLABELS":
-                            copy = True
-                            continue
-                        elif line.strip() == ";":
-                            break
-                        elif copy:
-                            tree.append(line.strip())
-                # .csv (truth db) file read
-                elif fname.endswith('.csv'):
-                    for line in f:
-                        # Get name for every line
-                        name = line.split(",", 1)[0]
-                        tree.append(name)
-                    # Remove first line of tree (info line)
-                    tree.pop(0)
-                trees.append(tree)
-
-    return dbs, tree
+            trees.append(read_tree_file(os.path.join(tree_path, filename)))
 
-def append_id(filename):
-    p = Path(filename)
-    return "{0}_{2}{1}".format(Path.joinpath(p.parent, p.stem), p.suffix, time.time())
+    return trees
 
-# Takes the completed taxa_list and writes a new file that includes the new taxa names and the rest of the data from db_path
-# TODO: handle multiple input dbs, perhaps with search
-def write_file(taxa_list, db_path, species_index):
 
-    outfile_path = append_id(db_path)
+def read_files(db_path, tree_path, species_name_index):
+    dbs = read_dbs(db_path, species_name_index)
+    trees = read_trees(tree_path)
+
+    return dbs, trees[-1]
 
-    with open(outfile_path, "w", encoding="utf-8") as outf:
 
-        with open(db_path, 'r', encoding="utf-8") as f:  # open in readonly mode
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
 
-            i = 0
 
-            for line in f:
+# Bump when TreeIndex changes, so compiled indexes from older versions are rebuilt
+TREE_INDEX_VERSION = 1
 
-                if i == 0:
-                    outf.write(line)
-                    i += 1
-                else:
-                    csv_list = line.strip().split(",")
-                    # Replace first line with new name, only if not blank
-                    if taxa_list[i - 1] != "":
-                        csv_list[species_index] = taxa_list[i - 1]
-                    outf.write(f"{','.join(csv_list)}\n")
-                    i += 1
 
-    return outfile_path
+def _write_compiled_tree_index(index_path, compiled):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+
+
+# Returns the TreeIndex for a tree file. With an index_dir (e.g. the cache directory), the built index is kept
+# in a tree-index folder there and loaded in one read on later runs. It is trusted while the tree file's size and
+# mtime are unchanged; after that the file is hashed, and the index is only rebuilt if the contents changed.
+def load_tree_index(tree_path, index_dir=None, db_separator="_", levenshtein_num=4):
+    if index_dir is None or os.path.isdir(tree_path):
+        return TreeIndex(read_trees(tree_path)[-1], db_separator, levenshtein_num)
+
+    stat = os.stat(tree_path)
+    key = f"{os.path.abspath(tree_path)}\n{db_separator}\n{int(levenshtein_num)}"
+    index_path = os.path.join(index_dir, "tree-index", f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.pickle")
+
+    try:
+        with open(index_path, 'rb') as f:
+            compiled = pickle.loads(f.read())
+        if compiled["version"] != TREE_INDEX_VERSION:
+            compiled = None
+    except Exception:
+        compiled = None
+
+    if compiled and compiled["size"] == stat.st_size and compiled["mtime_ns"] == stat.st_mtime_ns:
+        return compiled["tree_index"]
+
+    current_hash = file_hash(tree_path)
+    if compiled and compiled["file_hash"] == current_hash:
+        # Touched but not changed
+        tree_index = compiled["tree_index"]
+    else:
+        tree_index = TreeIndex(read_tree_file(tree_path), db_separator, levenshtein_num)
+
+    _write_compiled_tree_index(index_path, {
+        "version": TREE_INDEX_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "file_hash": current_hash,
+        "tree_index": tree_index,
+    })
+    return tree_index
+
+
+def append_id(filename):
+    p = Path(filename)
+    return "{0}_{2}{1}".format(Path.joinpath(p.parent, p.stem), p.suffix, time.time())
+
+# Writes a new file with the rest of the data from db_path, where each DB name found in replacements
+# (db name -> chosen tree name) is swapped for its replacement
+# TODO: handle multiple input dbs, perhaps with search
+def write_file(replacements, db_path, species_index):
+
+    outfile_path = append_id(db_path)
+
+    return rewrite_db_column(db_path, outfile_path, species_index, replacements)
 
 
 def get_wiki_image(search_term):
@@ -196,44 +305,59 @@ def get_wiki_image(search_term):
         return 0
 
 
-@lru_cache(maxsize=None)
+# Returns the summary for topic, from cache if given (e.g. a TieredCache), otherwise downloaded and cached
+# with the TTL of its status. Only failed requests are cached as TRANSIENT, and so retried soon
 def get_wiki_section(topic, cache=None, n=10):
-    if cache and topic in cache:
-        return cache.get(topic)
-    else:
-        try:
-            summary = wikipedia.summary(topic, sentences=n)
-        except:
-            summary = "No Info"
-        return summary
+    if cache is not None:
+        entry = info_entry(cache.get(topic))
+        if entry is not None:
+            return entry[1]
+    try:
+        status, summary = FOUND, wikipedia.summary(topic, sentences=n)
+    except wikipedia.exceptions.DisambiguationError:
+        status, summary = AMBIGUOUS, NO_INFO
+    except wikipedia.exceptions.PageError:
+        status, summary = ABSENT, NO_INFO
+    except Exception:
+        # Connection errors, timeouts and HTTP errors
+        status, summary = TRANSIENT, NO_INFO
+    if cache is not None:
+        cache.set(topic, (status, summary), expire=STATUS_TTL[status])
+    return summary
 
 
 # Takes list and returns wiki first paragraph for each entry
-def get_wiki_info(search_terms):
-    p = multiprocessing.Pool(multiprocessing.cpu_count())
-    wiki_entries = p.map(get_wiki_section, search_terms)
-    return wiki_entries
+def get_wiki_info(search_terms, endpoint=WIKI_API, concurrency=LOOKUP_CONCURRENCY):
+    search_terms = list(search_terms)
+    with WikiLookup(endpoint, concurrency) as lookup:
+        wiki_entries = lookup.fetch(search_terms)
+    return [wiki_entries[term][1] for term in search_terms]
 
 
+# Taxa info used to live in one JSON file at path/fname, rewritten in full on every update. It is now kept in an
+# indexed cache in the path directory: the JSON file is moved in the first time, and updates only write the
+# entries given
 def write_wiki_file(new_data, path, fname):
-    try:
-        with open(f"{path}/{fname}", "r") as f:
-            current_data = json.load(f)
-            full_data = current_data | new_data
-        with open(f"{path}/{fname}", "w") as f:
-            json.dump(full_data, f, indent=6, sort_keys=True)
-    except:
-        with open(f"{path}/{fname}", "w") as f:
-            json.dump(new_data, f, indent=6, sort_keys=True)
+    with open_cache(path) as cache:
+        migrate_legacy_info(cache, os.path.join(path, fname))
+        with cache.transact():
+            for taxon, summary in new_data.items():
+                entry = info_entry(summary)
+                if entry is not None:
+                    cache.set(taxon, entry, expire=STATUS_TTL[entry[0]])
 
 
+# Returns {taxon: summary} for the taxa info kept in the path directory
 def read_wiki_file(path, fname):
-    try:
-        with open(f"{path}/{fname}", 'r') as f:
-            dict = json.load(f)
-        return dict
-    except:
-        return {}
+    with open_cache(path) as cache:
+        migrate_legacy_info(cache, os.path.join(path, fname))
+        info = {}
+        for key in cache.iterkeys():
+            if isinstance(key, str):
+                entry = info_entry(cache.get(key))
+                if entry is not None:
+                    info[key] = entry[1]
+        return info
 
 
 # checks information in info and ensures it has entries for every possible match
@@ -262,7 +386,8 @@ def flatten(xss):
             for x in xs:
                 if type(x) is list:
                     flat_list.extend(x)
-                else:
+                # Skip the loose_suggestion flag
+                elif isinstance(x, str):
                     flat_list.append(x)
 
 
@@ -273,5 +398,6 @@ if __name__ == '__main__':
     info = read_wiki_file("dat/info", "info.json")
     suggestions = match("dat/db", "dat/tree")
     missing_info = validate_info(info, suggestions)
+    missing_info = list(missing_info)
     wiki_info = get_wiki_info(missing_info)
-    write_wiki_file(wiki_info, "dat/info", "info.json")
+    write_wiki_file(dict(zip(missing_info, wiki_info)), "dat/info", "info.json")
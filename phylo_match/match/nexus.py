@@ -0,0 +1,118 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import re
+
+# Whitespace, [comments], 'quoted' or "quoted" labels, punctuation, and bare words.
+# The final "." catches the start of a comment or quote that is not closed yet in the current buffer
+TOKEN_RE = re.compile(r"""\s+|\[[^\]]*\]|'(?:[^']|'')*'(?!')|"[^"]*"|[(),;:=]|[^\s()\[\],;:='"]+|.""", re.DOTALL)
+PUNCTUATION = set("(),;:=")
+
+CHUNK_SIZE = 1 << 16
+
+
+# Yields NEXUS tokens from an open text file, reading it in chunks so memory stays constant however big
+# the file is. Comments are skipped and quoted labels are returned without their quotes, with blanks turned into
+# underscores, which mean the same in NEXUS: 'Pan troglodytes' is Pan_troglodytes.
+# Punctuation is returned as-is, so a quoted label "(" can't be told apart from an actual "(".
+def iter_nexus_tokens(f, chunk_size=CHUNK_SIZE):
+    buffer = ""
+    pos = 0
+    eof = False
+    while True:
+        m = TOKEN_RE.match(buffer, pos)
+        # A token touching the end of the buffer may continue in the next chunk. A quoted label needs one
+        # character of lookahead, since '' inside quotes is an escaped quote rather than the closing one
+        if m is None:
+            incomplete = True
+        else:
+            lookahead = 1 if m.group()[0] == "'" else 0
+            incomplete = m.end() + lookahead >= len(buffer) or m.group() in ("[", "'", '"')
+        if incomplete and not eof or m is None:
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        token = m.group()
+        pos = m.end()
+        if token[0].isspace() or token[0] == "[":
+            continue
+        if token[0] == "'" and len(token) > 1:
+            yield token[1:-1].replace("''", "'").replace(" ", "_")
+        elif token[0] == '"' and len(token) > 1:
+            yield token[1:-1].replace(" ", "_")
+        else:
+            yield token
+
+
+# Returns the tokens up to (not including) the ";" that ends the current command
+def _read_command(tokens):
+    command = []
+    for token in tokens:
+        if token == ";":
+            break
+        command.append(token)
+    return command
+
+
+# Taxon labels of a Newick tree: any label that directly follows "(", "," or the "=" of the TREE command.
+# Labels after ")" are internal node labels and labels after ":" are branch lengths.
+def _newick_tips(command):
+    tips = []
+    previous = None
+    for token in command:
+        if token not in PUNCTUATION and previous in ("(", ",", "="):
+            tips.append(token)
+        previous = token
+    return tips
+
+
+# Reads the taxa of a NEXUS file, from whichever comes first of TAXLABELS, a TRANSLATE table,
+# or the tips of the first TREE. Stops reading as soon as the taxon set is complete.
+def read_nexus_taxa(path, chunk_size=CHUNK_SIZE):
+    with open(path, 'r', encoding="utf-8") as f:
+        tokens = iter_nexus_tokens(f, chunk_size)
+        for token in tokens:
+            command = token.upper()
+            if command == "#NEXUS":
+                continue
+            elif command == "TAXLABELS":
+                return _read_command(tokens)
+            elif command == "TRANSLATE":
+                # "key label, key label, ..." - keep the labels in table order
+                labels = []
+                entry = []
+                for token in _read_command(tokens) + [","]:
+                    if token == ",":
+                        if entry:
+                            labels.append(entry[-1])
+                        entry = []
+                    else:
+                        entry.append(token)
+                return labels
+            elif command in ("TREE", "UTREE"):
+                return _newick_tips(_read_command(tokens))
+            elif command != ";":
+                _read_command(tokens)
+    return []
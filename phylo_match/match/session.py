@@ -0,0 +1,200 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+from phylo_match.match.match import file_hash
+
+# Bump when the snapshot or journal format changes, so sessions from older versions are started over
+SESSION_VERSION = 1
+SNAPSHOT_FILE = "snapshot.pickle"
+JOURNAL_FILE = "journal.jsonl"
+
+
+HASHES_FILE = "hashes.pickle"
+
+
+# Hashes of the files sessions were opened for, by absolute path, so an unchanged DB or tree is not read again
+# on every run. A hash is trusted while the file's size and mtime are unchanged, as in load_tree_index
+def _load_hashes(hashes_path):
+    try:
+        with open(hashes_path, 'rb') as f:
+            hashes = pickle.loads(f.read())
+        if hashes.pop("version") != SESSION_VERSION:
+            return {}
+        return hashes
+    except Exception:
+        return {}
+
+
+# Files that no longer exist are dropped, so there is at most one entry per file still around
+def _write_hashes(hashes_path, hashes):
+    hashes = {path: entry for path, entry in hashes.items() if os.path.exists(path)}
+    hashes["version"] = SESSION_VERSION
+    os.makedirs(os.path.dirname(hashes_path), exist_ok=True)
+    tmp_path = f"{hashes_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(hashes, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, hashes_path)
+
+
+# Hash of one file, from hashes (abspath -> (size, mtime_ns, hash)) if it is there and the file is unchanged.
+# New hashes are added to it
+def _file_hash(path, hashes):
+    if hashes is None:
+        return file_hash(path)
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    entry = hashes.get(path)
+    if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+        return entry[2]
+    current_hash = file_hash(path)
+    hashes[path] = (stat.st_size, stat.st_mtime_ns, current_hash)
+    return current_hash
+
+
+# Hash of a DB or tree path. A folder hashes the names and contents of its files, skipping hidden ones
+# like read_dbs and read_trees do
+def _path_hash(path, hashes=None):
+    if not os.path.isdir(path):
+        return _file_hash(path, hashes)
+    sha = hashlib.sha256()
+    for filename in sorted(os.listdir(path)):
+        if not filename.startswith('.'):
+            sha.update(f"{filename}\n{_file_hash(os.path.join(path, filename), hashes)}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+
+# Identifies a review of one DB against one tree with the given settings. Editing either file starts a new session
+def session_key(db_path, tree_path, species_index, db_separator="_", levenshtein_num=4, hashes=None):
+    key = f"{SESSION_VERSION}\n{_path_hash(db_path, hashes)}\n{_path_hash(tree_path, hashes)}\n" \
+          f"{int(species_index)}\n{db_separator}\n{int(levenshtein_num)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Writes the records that need review to a snapshot file as they are made. Each record is pickled when added,
+# so later edits by the review window don't reach the file. The file only replaces the session's snapshot on
+# commit(); leaving the with block without committing (e.g. a cancelled run) throws it away.
+# The validation report of the run is kept with it, so a resumed review shows the same warnings
+class SnapshotWriter:
+    def __init__(self, path, perfect_matches, report=None):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.tmp_path, 'wb')
+        self.committed = False
+        pickle.dump({"version": SESSION_VERSION, "perfect_matches": perfect_matches, "report": report}, self.file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+    def add(self, record):
+        pickle.dump(record, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        self.committed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.committed:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+
+# A review that can be picked up again after the program exits or crashes. It keeps a snapshot of the match
+# output, so a resumed review needs no matching, and an append-only journal of decisions, one JSON line each,
+# synced to disk as it is made. Decisions are in review order, so the first records of the snapshot are the
+# decided ones.
+class Session:
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.journal = None
+        os.makedirs(directory, exist_ok=True)
+
+    # Returns (perfect matches, records that need review, validation report) from the last completed run, or None
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                header = pickle.load(f)
+                if header.get("version") != SESSION_VERSION:
+                    return None
+                records = []
+                while True:
+                    try:
+                        records.append(pickle.load(f))
+                    except EOFError:
+                        break
+        except Exception:
+            return None
+        return header["perfect_matches"], records, header["report"]
+
+    def write_snapshot(self, perfect_matches, report=None):
+        return SnapshotWriter(self.snapshot_path, perfect_matches, report)
+
+    # Returns the decisions made so far as (db name, chosen name) pairs, "" for left as is. A line cut short by
+    # a crash is dropped from the file, so later decisions start on a line of their own
+    def decisions(self):
+        try:
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) < len(data):
+            os.truncate(self.journal_path, len(complete))
+        return [tuple(json.loads(line)) for line in complete.decode("utf-8").splitlines() if line]
+
+    def record(self, db_name, choice):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.journal.write(json.dumps([db_name, choice]) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    # Removes the session once the output file is written, so finished reviews take no space
+    def finish(self):
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Opens the session for a DB and tree in the sessions folder of a cache directory. The files' hashes are kept
+# there too, and only recomputed for files that were modified since the last run
+def open_session(cache_dir, db_path, tree_path, species_index, db_separator="_", levenshtein_num=4):
+    sessions_dir = os.path.join(cache_dir, "sessions")
+    hashes_path = os.path.join(sessions_dir, HASHES_FILE)
+    hashes = _load_hashes(hashes_path)
+    known = dict(hashes)
+    key = session_key(db_path, tree_path, species_index, db_separator, levenshtein_num, hashes)
+    if hashes != known:
+        _write_hashes(hashes_path, hashes)
+    return Session(os.path.join(sessions_dir, key))
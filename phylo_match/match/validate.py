@@ -0,0 +1,157 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import sys
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+
+from phylo_match.match.match import read_dbs, read_trees
+
+# Names listed per problem in a summary line; the full lists are in ValidationReport.details()
+SUMMARY_NAMES = 10
+
+
+# Spelling of a name with whitespace runs and separators treated alike and case ignored, so names that only
+# differ in those get the same key
+def variant_key(name, separator="_"):
+    return separator.join(name.replace(separator, " ").split()).casefold()
+
+
+# Problems found in a DB and tree before matching. Every problem name is listed once, however often it occurs:
+#   duplicates        DB name -> number of times it appears
+#   no_separator      DB names without the separator
+#   variants          groups of DB names that only differ in whitespace or case
+#   tree_variants     (DB name, tree name) pairs that only differ in whitespace or case
+#   tree_duplicates   tree name -> number of times it appears
+#   bad_tree_labels   tree names without the separator, or with whitespace around them
+class ValidationReport:
+    def __init__(self, separator="_"):
+        self.separator = separator
+        self.duplicates = {}
+        self.no_separator = []
+        self.variants = []
+        self.tree_variants = []
+        self.tree_duplicates = {}
+        self.bad_tree_labels = []
+
+    def __bool__(self):
+        return any(self.sections().values())
+
+    def sections(self):
+        return {
+            "duplicates": self.duplicates,
+            "no_separator": self.no_separator,
+            "variants": self.variants,
+            "tree_variants": self.tree_variants,
+            "tree_duplicates": self.tree_duplicates,
+            "bad_tree_labels": self.bad_tree_labels,
+        }
+
+    # (heading, lines) for each problem found
+    def _describe(self):
+        sep = self.separator
+        if self.duplicates:
+            yield f"{len(self.duplicates)} database entries appear multiple times", \
+                [f"{name} ({count}x)" for name, count in self.duplicates.items()]
+        if self.no_separator:
+            yield f"{len(self.no_separator)} database entries have no '{sep}' and are possibly malformed", \
+                self.no_separator
+        if self.variants:
+            yield f"{len(self.variants)} database entries are spelled with different spacing or case", \
+                [" / ".join(group) for group in self.variants]
+        if self.tree_variants:
+            yield f"{len(self.tree_variants)} database entries match a tree entry except for spacing or case", \
+                [f"{db_name} -> {tree_name}" for db_name, tree_name in self.tree_variants]
+        if self.tree_duplicates:
+            yield f"{len(self.tree_duplicates)} tree entries appear multiple times", \
+                [f"{name} ({count}x)" for name, count in self.tree_duplicates.items()]
+        if self.bad_tree_labels:
+            yield f"{len(self.bad_tree_labels)} tree entries are possibly malformed", \
+                [f"[{name}]" for name in self.bad_tree_labels]
+
+    # One line per problem, naming the first few entries
+    def summary(self):
+        lines = []
+        for heading, names in self._describe():
+            shown = ", ".join(names[:SUMMARY_NAMES])
+            more = f" and {len(names) - SUMMARY_NAMES} more" if len(names) > SUMMARY_NAMES else ""
+            lines.append(f"{heading}: {shown}{more}")
+        return "\n".join(lines)
+
+    # Every problem entry, one per line under its heading
+    def details(self):
+        return "\n\n".join(f"{heading}:\n" + "\n".join(f"  {name}" for name in names)
+                           for heading, names in self._describe())
+
+
+# Checks DB and tree names in one pass over each, counting names and their variant keys in hash tables.
+# dbs is a list of lists of names, as from read_dbs; tree is any iterable of names, e.g. a TreeIndex's names
+def validate(dbs, tree, separator="_"):
+    report = ValidationReport(separator)
+
+    db_counts = Counter()
+    db_spellings = defaultdict(dict)  # variant key -> distinct spellings, in order of appearance
+    for db in dbs:
+        for name in db:
+            db_counts[name] += 1
+            if db_counts[name] == 1:
+                db_spellings[variant_key(name, separator)][name] = None
+                if separator not in name:
+                    report.no_separator.append(name)
+    report.duplicates = {name: count for name, count in db_counts.items() if count > 1}
+    report.variants = [list(spellings) for spellings in db_spellings.values() if len(spellings) > 1]
+
+    tree_counts = Counter()
+    tree_spellings = {}  # variant key -> first tree spelling
+    for name in tree:
+        tree_counts[name] += 1
+        if tree_counts[name] == 1:
+            tree_spellings.setdefault(variant_key(name, separator), name)
+            if separator not in name or name != name.strip():
+                report.bad_tree_labels.append(name)
+    report.tree_duplicates = {name: count for name, count in tree_counts.items() if count > 1}
+
+    for key, spellings in db_spellings.items():
+        tree_name = tree_spellings.get(key)
+        if tree_name is not None:
+            report.tree_variants.extend((name, tree_name) for name in spellings if name not in tree_counts)
+
+    return report
+
+
+def main():
+    parser = ArgumentParser(prog="phylo-match-validate",
+                            description="Check a database and tree for duplicates and malformed names before matching")
+    parser.add_argument("db", help="database file (.csv), or a folder of them")
+    parser.add_argument("tree", help="tree file (.nex) or truth database (.csv)")
+    parser.add_argument("--column", type=int, default=0, help="species column of the database, counting from 0")
+    parser.add_argument("--separator", default="_", help="separator between genus and species (default: _)")
+    parser.add_argument("--summary", action="store_true", help="list only the first few entries of each problem")
+
+    args = parser.parse_args()
+    report = validate(read_dbs(args.db, args.column), read_trees(args.tree)[-1], args.separator)
+    if not report:
+        print("No problems found")
+        return
+    print(report.summary() if args.summary else report.details())
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+
+import pytest
+
+from phylo_match.match.dbfile import read_db_column, rewrite_db_column
+
+DB = (b'name,mass,notes\r\n'
+      b'Homo_sapiens,70,"tall, upright"\r\n'
+      b'Pan_troglodyte,50,plain\r\n'
+      b'Gorilla_gorila,"160","says ""hi""\nand more"\n'
+      b'\n'
+      b'  Pongo_abeli  ,40,x\r\n'
+      b'Caf\xc3\xa9_sp,1,\xc3\xa9t\xc3\xa9\n'
+      b'Hylobates_lar,6,no line break at the end')
+
+FILES = {
+    "mixed": DB,
+    "lf": DB.replace(b"\r\n", b"\n"),
+    "crlf": DB.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n"),
+    "trailing_break": DB + b"\n",
+    "header_only": b"name,mass\n",
+    "empty": b"",
+}
+
+
+def write(tmp_path, data):
+    path = tmp_path / "db.csv"
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_unchanged_rows_are_copied_byte_for_byte(tmp_path, name):
+    path = write(tmp_path, FILES[name])
+    out = str(tmp_path / "out.csv")
+    rewrite_db_column(path, out, 0, {"Not_in_file": "Anything"})
+    with open(out, 'rb') as f:
+        assert f.read() == FILES[name]
+
+
+def test_only_replaced_fields_change(tmp_path):
+    path = write(tmp_path, DB)
+    out = str(tmp_path / "out.csv")
+    rewrite_db_column(path, out, 0, {
+        "name": "Header_is_kept",
+        "Pan_troglodyte": "Pan_troglodytes",
+        "Gorilla_gorila": "Gorilla_gorilla",
+        "Pongo_abeli": "Pongo_abelii",
+        # Empty means no replacement
+        "Homo_sapiens": "",
+    })
+    with open(out, 'rb') as f:
+        assert f.read() == (b'name,mass,notes\r\n'
+                            b'Homo_sapiens,70,"tall, upright"\r\n'
+                            b'Pan_troglodytes,50,plain\r\n'
+                            # Records with quotes are written again by the csv module
+                            b'Gorilla_gorilla,160,"says ""hi""\nand more"\n'
+                            b'\n'
+                            b'Pongo_abelii,40,x\r\n'
+                            b'Caf\xc3\xa9_sp,1,\xc3\xa9t\xc3\xa9\n'
+                            b'Hylobates_lar,6,no line break at the end')
+    assert read_db_column(out, 0) == ["Homo_sapiens", "Pan_troglodytes", "Gorilla_gorilla", "", "Pongo_abelii",
+                                      "Café_sp", "Hylobates_lar"]
+
+
+def test_other_column(tmp_path):
+    path = write(tmp_path, b"id,name\r\n1,Pan_troglodyte\r\n2,Homo_sapiens\r\n")
+    out = str(tmp_path / "out.csv")
+    rewrite_db_column(path, out, 1, {"Pan_troglodyte": "Pan_troglodytes"})
+    with open(out, 'rb') as f:
+        assert f.read() == b"id,name\r\n1,Pan_troglodytes\r\n2,Homo_sapiens\r\n"
+
+
+def test_no_temporary_files_left(tmp_path):
+    path = write(tmp_path, DB)
+    rewrite_db_column(path, str(tmp_path / "out.csv"), 0, {"Pan_troglodyte": "Pan_troglodytes"})
+    assert sorted(os.listdir(tmp_path)) == ["db.csv", "out.csv"]
+
+
+@pytest.mark.parametrize("data, message", [
+    # Never closed: the rest of the file would become one name
+    (b'Species,a\nMus_a,1\n"Mus_b,2\nMus_c,3\n', "malformed row 3 (line 3)"),
+    # Closed on a later line
+    (b'Species,a\nMus_a,1\n"Mus_b,2\nMus_c",3\nMus_d,4\n', "row 3 (line 3) has a line break"),
+    # Text after the closing quote
+    (b'Species,a\nMus_a,1\n"Mus_b"x,2\n', "malformed row 3 (line 3)"),
+], ids=["unclosed", "closed_later", "after_quote"])
+def test_stray_quotes_are_reported_at_their_row(tmp_path, data, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        read_db_column(write(tmp_path, data), 0)
+
+
+def test_line_breaks_allowed_in_other_columns(tmp_path):
+    path = write(tmp_path, b'Species,notes\nMus_a,"two\nlines"\nMus_b,x\n')
+    assert read_db_column(path, 0) == ["Mus_a", "Mus_b"]
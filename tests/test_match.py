@@ -0,0 +1,210 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import copy
+import os
+import random
+
+import pytest
+from diskcache import Cache
+from Levenshtein import distance as levenshtein_distance
+
+import phylo_match.match.match as match_module
+from phylo_match.match.match import match, iter_match, read_tree_file
+from phylo_match.match.index import TreeIndex
+
+
+# match() as it was before the tree index: every DB name compared with every tree name
+def reference_match(dbs, tree, db_separator="_", levenshtein_num=4):
+    output = []
+    difference_threshold = int(levenshtein_num)
+    for db in dbs:
+        for db_name in db:
+            suggestions = []
+            loose_suggestions = []
+            genus_match = []
+            species_match = []
+            genus_name = db_name.split(db_separator, 1)[0]
+            species_name = db_name.split(db_separator, 1)[1] if db_separator in db_name else ""
+
+            found_match = False
+            for tree_name in tree:
+                tree_genus_name = tree_name.split(db_separator, 1)[0]
+                tree_species_name = tree_name.split(db_separator, 1)[1] if db_separator in tree_name else ""
+
+                if db_name == tree_name:
+                    found_match = True
+                    break
+                elif levenshtein_distance(db_name, tree_name) < difference_threshold:
+                    suggestions.append(tree_name)
+                elif genus_name == tree_genus_name:
+                    genus_match.append(tree_name)
+                elif levenshtein_distance(genus_name, tree_genus_name) < (difference_threshold - 1):
+                    loose_suggestions.append(tree_name)
+                elif species_name == tree_species_name:
+                    species_match.append(tree_name)
+                elif levenshtein_distance(species_name, tree_species_name) < (difference_threshold - 1):
+                    loose_suggestions.append(tree_name)
+
+            loose_suggestion = False
+            if len(suggestions) == 0 and len(loose_suggestions) > 0:
+                suggestions = suggestions + loose_suggestions
+                loose_suggestion = True
+            if found_match:
+                output.append(db_name)
+            else:
+                output.append([db_name, suggestions, species_match, genus_match, loose_suggestion])
+    return output
+
+
+# A small alphabet and short words, so names are often within a few edits of each other
+def random_word(rng, max_length):
+    return "".join(rng.choice("abcde") for _ in range(rng.randint(0, max_length)))
+
+
+def random_name(rng):
+    kind = rng.random()
+    if kind < 0.05:
+        return ""
+    if kind < 0.15:
+        # No separator
+        return random_word(rng, 8)
+    if kind < 0.2:
+        # More than one separator
+        return f"{random_word(rng, 4)}_{random_word(rng, 4)}_{random_word(rng, 3)}"
+    return f"{random_word(rng, 6).capitalize()}_{random_word(rng, 8)}"
+
+
+def random_case(seed):
+    rng = random.Random(seed)
+    tree = [random_name(rng) for _ in range(rng.randint(1, 60))]
+    db = [random_name(rng) for _ in range(rng.randint(1, 40))]
+    # Some DB names taken from the tree, some of them slightly misspelled
+    for _ in range(10):
+        name = rng.choice(tree)
+        if name and rng.random() < 0.5:
+            i = rng.randrange(len(name))
+            name = name[:i] + rng.choice("abcdef") + name[i + 1:]
+        db.append(name)
+    rng.shuffle(db)
+    return [db], tree
+
+
+@pytest.mark.parametrize("levenshtein_num", range(0, 7))
+@pytest.mark.parametrize("seed", range(40))
+def test_match_agrees_with_reference(seed, levenshtein_num):
+    dbs, tree = random_case(seed)
+    output, perfect_matches = match(dbs, tree, "_", levenshtein_num)
+    expected = reference_match(dbs, tree, "_", levenshtein_num)
+    assert output == expected
+    assert perfect_matches == [result for result in expected if type(result) is str]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_prebuilt_index_and_workers_agree_with_reference(seed):
+    dbs, tree = random_case(1000 + seed)
+    tree_index = TreeIndex(tree, "_", 4)
+    output, _ = match(dbs, tree_index, "_", 4, workers=2)
+    assert output == reference_match(dbs, tree, "_", 4)
+
+
+def test_other_separator():
+    dbs, tree = random_case(2000)
+    dbs = [[name.replace("_", " ") for name in dbs[0]]]
+    tree = [name.replace("_", " ") for name in tree]
+    output, _ = match(dbs, tree, " ", 3)
+    assert output == reference_match(dbs, tree, " ", 3)
+
+
+TREE_PATH = os.path.join(os.path.dirname(__file__), "..", "dat", "tree", "Upham.nex")
+
+
+def test_real_tree():
+    tree = read_tree_file(TREE_PATH)
+    rng = random.Random(3000)
+    db = []
+    for name in rng.sample(tree, 150):
+        i = rng.randrange(len(name))
+        db.append(name[:i] + name[i + 1:])
+    db += rng.sample(tree, 20)
+    output, _ = match([db], tree, "_", 4)
+    assert output == reference_match([db], tree, "_", 4)
+
+
+# The review window trims suggestion lists while later results are still being matched and cached
+def test_editing_results_changes_neither_repeats_nor_cache(tmp_path):
+    dbs, tree = random_case(4000)
+    dbs = [dbs[0] + dbs[0]]
+    expected = reference_match(dbs, tree, "_", 4)
+    with Cache(str(tmp_path)) as cache:
+        output = []
+        for result in iter_match(dbs, tree, "_", 4, cache=cache):
+            output.append(copy.deepcopy(result))
+            if type(result) is not str:
+                for suggestions in result[1:4]:
+                    suggestions.clear()
+        assert output == expected
+        assert list(iter_match(dbs, tree, "_", 4, cache=cache)) == expected
+
+
+# Counts the names match_name is called for, without changing its results
+def count_matched(monkeypatch):
+    matched = []
+    match_name = match_module.match_name
+    monkeypatch.setattr(match_module, "match_name",
+                        lambda tree_index, db_name: matched.append(db_name) or match_name(tree_index, db_name))
+    return matched
+
+
+def test_rerun_matches_only_new_names(tmp_path, monkeypatch):
+    dbs, tree = random_case(5000)
+    matched = count_matched(monkeypatch)
+    with Cache(str(tmp_path)) as cache:
+        match(dbs, tree, "_", 4, cache=cache)
+        assert sorted(matched) == sorted(set(dbs[0]))
+
+        matched.clear()
+        dbs = [dbs[0] + ["Zzyzx_newname"]]
+        output, _ = match(dbs, tree, "_", 4, cache=cache)
+        assert matched == ["Zzyzx_newname"]
+        assert output == reference_match(dbs, tree, "_", 4)
+
+
+def test_editing_the_tree_invalidates_results(tmp_path, monkeypatch):
+    dbs, tree = random_case(6000)
+    matched = count_matched(monkeypatch)
+    with Cache(str(tmp_path)) as cache:
+        match(dbs, tree, "_", 4, cache=cache)
+
+        matched.clear()
+        tree = tree[1:] + ["Zzyzx_newname"]
+        output, _ = match(dbs, tree, "_", 4, cache=cache)
+        assert sorted(matched) == sorted(set(dbs[0]))
+        assert output == reference_match(dbs, tree, "_", 4)
+
+
+def test_results_from_other_cache_versions_are_not_used(tmp_path, monkeypatch):
+    dbs, tree = random_case(7000)
+    with Cache(str(tmp_path)) as cache:
+        match(dbs, tree, "_", 4, cache=cache)
+
+        matched = count_matched(monkeypatch)
+        monkeypatch.setattr(match_module, "MATCH_CACHE_VERSION", match_module.MATCH_CACHE_VERSION + 1)
+        match(dbs, tree, "_", 4, cache=cache)
+        assert sorted(matched) == sorted(set(dbs[0]))
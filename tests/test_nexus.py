@@ -0,0 +1,99 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+
+import pytest
+
+from phylo_match.match.nexus import read_nexus_taxa
+
+TREE_PATH = os.path.join(os.path.dirname(__file__), "..", "dat", "tree", "Upham.nex")
+# Small chunks put token, comment and quote boundaries at every possible place in the buffer
+CHUNK_SIZES = [1, 2, 3, 5, 7, 13, 64]
+
+TAXLABELS = """#NEXUS
+[written by hand; with a [comment] that mentions TAXLABELS]
+BEGIN TAXA;
+    DIMENSIONS NTAX = 6;
+    TAXLABELS
+        Homo_sapiens
+        'Pan troglodytes'
+        'Gorilla''s_gorilla'
+        "Pongo abelii"
+        Hylobates_lar[inline comment]
+        'it''s ''quoted'''
+    ;
+END;
+"""
+
+TRANSLATE = """#NEXUS
+BEGIN TREES;
+    TRANSLATE
+        1 Homo_sapiens,
+        2 'Pan troglodytes',
+        3 Gorilla_gorilla [trailing comment]
+    ;
+    TREE one = ((1:0.1,2:0.2)0.9:0.3,3:0.4);
+END;
+"""
+
+NEWICK = """#NEXUS
+BEGIN TREES;
+    TREE one = [&R] ((Homo_sapiens:1.5,'Pan troglodytes':2)inner:1,(Gorilla_gorilla,Pongo_abelii)90:3);
+    TREE two = (Not_read,Not_read_either);
+END;
+"""
+
+
+def write(tmp_path, text):
+    path = tmp_path / "tree.nex"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text, expected", [
+    (TAXLABELS, ["Homo_sapiens", "Pan_troglodytes", "Gorilla's_gorilla", "Pongo_abelii", "Hylobates_lar",
+                 "it's_'quoted'"]),
+    (TRANSLATE, ["Homo_sapiens", "Pan_troglodytes", "Gorilla_gorilla"]),
+    (NEWICK, ["Homo_sapiens", "Pan_troglodytes", "Gorilla_gorilla", "Pongo_abelii"]),
+], ids=["taxlabels", "translate", "newick"])
+def test_small_chunks(tmp_path, text, expected, chunk_size):
+    assert read_nexus_taxa(write(tmp_path, text), chunk_size) == expected
+
+
+# The line-by-line TAXLABELS reader the tokenizer replaced
+def reference_taxlabels(path):
+    tree = []
+    copy = False
+    with open(path, 'r', encoding="utf-8") as f:
+        for line in f:
+            if line.strip().upper() == "TAXLABELS":
+                copy = True
+                continue
+            elif line.strip() == ";":
+                break
+            elif copy:
+                tree.append(line.strip())
+    return tree
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1000, 1 << 16])
+def test_real_tree(chunk_size):
+    assert read_nexus_taxa(TREE_PATH, chunk_size) == reference_taxlabels(TREE_PATH)
@@ -0,0 +1,134 @@
+'''
+    Phylo-Match matches a .csv file full of data (species-level data) and
+    a nexus file containing a phylogenetic tree
+    Copyright (C) William Spear
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+
+import pytest
+
+import phylo_match.match.session as session_module
+from phylo_match.match.session import JOURNAL_FILE, Session, open_session
+
+RECORDS = [["Mus_a", [], [], [], False], ["Mus_b", [], [], [], False], ["Mus_c", [], [], [], False]]
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_decisions_round_trip(tmp_path):
+    session = Session(str(tmp_path / "session"))
+    session.record("Mus_a", "Mus_aa")
+    session.record("Mus_b", "")
+    session.close()
+    assert Session(str(tmp_path / "session")).decisions() == [("Mus_a", "Mus_aa"), ("Mus_b", "")]
+
+
+def test_partial_last_line_is_dropped(tmp_path):
+    session = Session(str(tmp_path / "session"))
+    session.record("Mus_a", "Mus_aa")
+    session.close()
+    with open(session.journal_path, 'ab') as f:
+        f.write(b'["Mus_b", "Mu')
+
+    session = Session(str(tmp_path / "session"))
+    assert session.decisions() == [("Mus_a", "Mus_aa")]
+    session.record("Mus_c", "")
+    session.close()
+    with open(session.journal_path, 'rb') as f:
+        assert f.read() == b'["Mus_a", "Mus_aa"]\n["Mus_c", ""]\n'
+    assert session.decisions() == [("Mus_a", "Mus_aa"), ("Mus_c", "")]
+
+
+def test_snapshot_is_replaced_only_on_commit(tmp_path):
+    session = Session(str(tmp_path / "session"))
+    assert session.load_snapshot() is None
+    with session.write_snapshot(["Homo_sapiens"]) as snapshot:
+        for record in RECORDS:
+            snapshot.add(record)
+        snapshot.commit()
+    assert session.load_snapshot() == (["Homo_sapiens"], RECORDS, None)
+
+    with session.write_snapshot(["Pan_troglodytes"]) as snapshot:
+        snapshot.add(RECORDS[0])
+    assert session.load_snapshot() == (["Homo_sapiens"], RECORDS, None)
+    assert sorted(os.listdir(session.directory)) == [session_module.SNAPSHOT_FILE]
+
+
+def test_file_hashes_are_reused_until_a_file_changes(tmp_path, monkeypatch):
+    hashed = []
+    file_hash = session_module.file_hash
+    monkeypatch.setattr(session_module, "file_hash", lambda path: hashed.append(path) or file_hash(path))
+    db_path = write(tmp_path / "db.csv", b"Species\nMus_a\n")
+    tree_path = write(tmp_path / "tree.csv", b"Species\nMus_a\n")
+    cache_dir = str(tmp_path / "cache")
+
+    first = open_session(cache_dir, db_path, tree_path, 0)
+    assert len(hashed) == 2
+
+    hashed.clear()
+    assert open_session(cache_dir, db_path, tree_path, 0).directory == first.directory
+    assert hashed == []
+
+    # Touched but not changed: hashed again, same session
+    stat = os.stat(db_path)
+    os.utime(db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert open_session(cache_dir, db_path, tree_path, 0).directory == first.directory
+    assert hashed == [os.path.abspath(db_path)]
+
+    hashed.clear()
+    write(tmp_path / "db.csv", b"Species\nMus_b\n")
+    os.utime(db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2000000000))
+    assert open_session(cache_dir, db_path, tree_path, 0).directory != first.directory
+    assert hashed == [os.path.abspath(db_path)]
+
+
+@pytest.fixture(scope="module")
+def app():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    QtWidgets = pytest.importorskip("PyQt6.QtWidgets")
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def replayed(tmp_path, decisions):
+    from phylo_match.gui import Compare
+    session = Session(str(tmp_path / "session"))
+    for db_name, choice in decisions:
+        session.record(db_name, choice)
+    session.close()
+    compare = Compare()
+    compare.set_session(session)
+    compare.pending = [list(record) for record in RECORDS]
+    return compare
+
+
+def test_replay_skips_decided_records(app, tmp_path):
+    compare = replayed(tmp_path, [("Mus_a", "Mus_aa"), ("Mus_b", "")])
+    assert compare.next_pending()[0] == "Mus_c"
+    assert compare.replacements == {"Mus_a": "Mus_aa"}
+    assert compare.chosen == {"Mus_aa"}
+    assert not compare.replay
+
+
+def test_replay_stops_when_records_do_not_line_up(app, tmp_path):
+    compare = replayed(tmp_path, [("Mus_b", "Mus_bb")])
+    assert compare.next_pending()[0] == "Mus_a"
+    assert compare.replacements == {}
+    assert not compare.replay